@@ -0,0 +1,122 @@
+from __future__ import print_function
+
+import os
+import re
+import sqlite3
+import threading
+
+import log_archive
+
+re_ts_digits = re.compile('[^0-9]')
+
+# Convert a user-supplied time such as "2018-01-10", "2018-01-10 23:01" or
+# "20180110T230149" into the fixed-width form used in the access log, so it
+# can be compared directly against indexed timestamps.
+def normalize_ts(s):
+    digits = re_ts_digits.sub('', s)[:14]
+    if len(digits) < 4:
+        raise ValueError('Invalid timestamp', s)
+    digits = digits.ljust(14, '0')
+    return digits[:8] + 'T' + digits[8:]
+
+# Parse an access log line: "20180110T230149.0,check,acl,rfid,result".
+# Returns (ts, seq, acl, rfid, result), or None for any other kind of line.
+def parse_line(l):
+    fields = l.split(',')
+    if len(fields) != 5 or fields[1] != 'check':
+        return None
+    (ts, seq) = fields[0].partition('.')[::2]
+    try:
+        seq = int(seq)
+    except ValueError:
+        return None
+    return (ts, seq, fields[2], fields[3], fields[4])
+
+# An index over the "check" records in all monthly access logs, stored in an
+# SQLite database. The byte offset up to which each log file has been indexed
+# is recorded, so that catching up only reads lines appended since the last
+# time. Archiving a log preserves its offsets, so an archived log that was
+# already fully indexed is never decompressed.
+class AccessIndex(object):
+    def __init__(self, db_fn, log_glob):
+        self.log_glob = log_glob
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_fn, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS files '
+                '(name TEXT PRIMARY KEY, offset INTEGER)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS checks '
+                '(ts TEXT, seq INTEGER, acl TEXT, rfid TEXT, result TEXT, '
+                'file TEXT)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS checks_ts '
+                'ON checks (ts, seq)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS checks_rfid '
+                'ON checks (rfid, ts, seq)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS checks_acl '
+                'ON checks (acl, result, ts, seq)')
+
+    def catch_up(self):
+        with self.lock:
+            offsets = dict(self.db.execute('SELECT name, offset FROM files'))
+            for fn in log_archive.glob_logs(self.log_glob):
+                name = os.path.basename(fn)
+                try:
+                    self._catch_up_file(fn, name, offsets.get(name, 0))
+                except FileNotFoundError:
+                    # Archived between globbing and opening; it'll be picked
+                    # up next time.
+                    pass
+
+    def _catch_up_file(self, fn, name, offset):
+        with log_archive.open_log(fn) as f:
+            if f.size == offset:
+                return
+            if f.size < offset:
+                # The file was replaced; index it from scratch.
+                with self.db:
+                    self.db.execute('DELETE FROM checks WHERE file = ?', (name,))
+                offset = 0
+            data = f.read(offset, f.size - offset)
+        # Leave any partially written final line for next time.
+        data = data[:data.rfind(b'\n') + 1]
+        rows = []
+        for l in data.decode('utf-8', 'replace').splitlines():
+            record = parse_line(l)
+            if record:
+                rows.append(record + (name,))
+        with self.db:
+            self.db.executemany('INSERT INTO checks VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?)',
+                (name, offset + len(data)))
+
+    # Return matching records as access log lines, newest first. start is
+    # inclusive and end is exclusive.
+    def query(self, rfid=None, acl=None, result=None, start=None, end=None,
+            limit=1000):
+        self.catch_up()
+        conds = []
+        args = []
+        if rfid is not None:
+            conds.append('rfid = ?')
+            args.append(rfid)
+        if acl is not None:
+            conds.append('acl = ?')
+            args.append(acl)
+        if result is not None:
+            conds.append('result = ?')
+            args.append(result)
+        if start is not None:
+            conds.append('ts >= ?')
+            args.append(normalize_ts(start))
+        if end is not None:
+            conds.append('ts < ?')
+            args.append(normalize_ts(end))
+        sql = 'SELECT ts, seq, acl, rfid, result FROM checks'
+        if conds:
+            sql += ' WHERE ' + ' AND '.join(conds)
+        sql += ' ORDER BY ts DESC, seq DESC LIMIT ?'
+        args.append(limit)
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return ['%s.%d,check,%s,%s,%s' % row for row in rows]
@@ -0,0 +1,202 @@
+from __future__ import print_function
+
+import collections
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+# How far each batch of log records is pushed towards the SD card:
+# - flush: hand the data to the OS (survives an auth server crash)
+# - fsync: also force it to disk (survives a power failure)
+durabilities = ('flush', 'fsync')
+
+log_write_seconds = metrics.Histogram('auth_server_access_log_write_seconds',
+    'Time taken to write (and flush or fsync) a batch of access log records')
+log_records = metrics.Counter('auth_server_access_log_records_total',
+    'Access log records written')
+log_write_errors = metrics.Counter('auth_server_access_log_write_errors_total',
+    'Failed access log batch writes')
+
+# Writes access log records from a background thread, so that request
+# handlers only need to queue a record, and never wait for the SD card.
+# Records are collected for up to flush_interval seconds and then written in
+# a single batch. Each record is written to the log file for the month in
+# which the record was generated, so batches that straddle a month boundary
+# are rotated correctly.
+class AccessLog(object):
+    def __init__(self, fn_template, ts_template, flush_interval=1.0,
+            durability='flush'):
+        if durability not in durabilities:
+            raise Exception('Invalid log durability', durability)
+        self.fn_template = fn_template
+        self.ts_template = ts_template
+        self.flush_interval = flush_interval
+        self.durability = durability
+
+        self.ts_lock = threading.Lock()
+        self.last_ts = None
+        self.ts_seq_num = 0
+
+        self.queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.threadfunc)
+        self.thread.daemon = True
+        self.f = None
+        self.f_fn = None
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.queue.put(None)
+        self.thread.join()
+
+    # Generate a unique timestamp, and the name of the log file that a record
+    # with that timestamp belongs in. The sequence number disambiguates
+    # multiple records generated within the same second.
+    def gen_ts(self):
+        with self.ts_lock:
+            now = time.localtime()
+            ts = time.strftime(self.ts_template, now)
+            if ts == self.last_ts:
+                self.ts_seq_num += 1
+            else:
+                self.ts_seq_num = 0
+            self.last_ts = ts
+            return (time.strftime(self.fn_template, now),
+                ts + str(self.ts_seq_num))
+
+    def log_check(self, acl, rfid, result):
+        self.log_checks(((acl, rfid, result),))
+
+    def log_checks(self, checks):
+        records = []
+        for (acl, rfid, result) in checks:
+            (fn, ts) = self.gen_ts()
+            records.append((fn, '%s,check,%s,%s,%s\n' % (ts, acl, rfid, result)))
+        self.queue.put(records)
+
+    # Log checks made elsewhere, with their original timestamps. These are
+    # written to the current month's log, since the log for the month they
+    # were made in may already have been archived, so logs aren't strictly
+    # in timestamp order (see log_archive.write_archive()). on_written, if
+    # given, is called by the writer thread once the records are written.
+    def log_timestamped_checks(self, checks, on_written=None):
+        fn = time.strftime(self.fn_template)
+        records = [(fn, '%s,check,%s,%s,%s\n' % check) for check in checks]
+        if on_written:
+            records.append((None, on_written))
+        self.queue.put(records)
+
+    def threadfunc(self):
+        stopping = False
+        while not stopping:
+            batches = [self.queue.get()]
+            self.stop_event.wait(self.flush_interval)
+            while True:
+                try:
+                    batches.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batches:
+                stopping = True
+            write_start = time.monotonic()
+            try:
+                self.write(flatten(batches))
+                log_write_seconds.observe(time.monotonic() - write_start)
+            except:
+                log_write_errors.inc()
+                print('EXCEPTION writing access log (squashed):', file=sys.stderr)
+                traceback.print_exc()
+                self.close()
+        self.close()
+
+    # A record with no file name holds a function to call once the records
+    # before it have been written.
+    def write(self, records):
+        count = 0
+        callbacks = []
+        for (fn, line) in records:
+            if fn is None:
+                callbacks.append(line)
+                continue
+            if fn != self.f_fn:
+                self.sync()
+                self.close()
+                self.f = open(fn, 'at')
+                self.f_fn = fn
+            self.f.write(line)
+            count += 1
+        self.sync()
+        log_records.inc(n=count)
+        for callback in callbacks:
+            callback()
+
+    def sync(self):
+        if not self.f:
+            return
+        self.f.flush()
+        if self.durability == 'fsync':
+            os.fsync(self.f.fileno())
+
+    def close(self):
+        if not self.f:
+            return
+        try:
+            self.f.close()
+        finally:
+            self.f = None
+            self.f_fn = None
+
+def flatten(batches):
+    for batch in batches:
+        if batch is None:
+            continue
+        for record in batch:
+            yield record
+
+# A bounded, thread-safe set of recently seen record IDs, used to discard
+# records that are resent (e.g. when a response to a controller was lost).
+# If db_fn is given, IDs passed to persist() are also kept in a table there,
+# and reloaded at startup, so a resend after a restart is still recognized.
+class RecentIds(object):
+    def __init__(self, max_ids=100000, db_fn=None):
+        self.max_ids = max_ids
+        self.ids = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.db = None
+        if db_fn:
+            self.db = sqlite3.connect(db_fn, check_same_thread=False)
+            with self.db:
+                self.db.execute('CREATE TABLE IF NOT EXISTS remote_ids '
+                    '(id TEXT PRIMARY KEY)')
+            for (record_id,) in self.db.execute('SELECT id FROM remote_ids '
+                    'ORDER BY rowid DESC LIMIT ?', (max_ids,)).fetchall()[::-1]:
+                self.ids[record_id] = None
+
+    # Returns True if the ID was not seen before, and records it.
+    def add(self, record_id):
+        with self.lock:
+            if record_id in self.ids:
+                return False
+            self.ids[record_id] = None
+            if len(self.ids) > self.max_ids:
+                self.ids.popitem(last=False)
+            return True
+
+    # Store IDs whose records have been written, keeping the newest max_ids.
+    def persist(self, record_ids):
+        if not self.db:
+            return
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR IGNORE INTO remote_ids (id) '
+                'VALUES (?)', ((record_id,) for record_id in record_ids))
+            self.db.execute('DELETE FROM remote_ids WHERE rowid <= '
+                '(SELECT MAX(rowid) FROM remote_ids) - ?', (self.max_ids,))
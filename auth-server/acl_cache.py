@@ -0,0 +1,236 @@
+from __future__ import print_function
+
+import collections
+import hashlib
+import os
+import threading
+import time
+
+import metrics
+
+# Minimum time between stat() calls on a given ACL file. Lookups within this
+# window are answered purely from memory.
+stat_interval = 1.0
+
+# Number of previous generations of each ACL kept, so that clients can fetch
+# just the changes since a version they already have.
+history_len = 8
+
+acl_reads = metrics.Counter('auth_server_acl_reads_total',
+    'ACL files (re-)read after a change was detected', ('acl',))
+acl_generations = metrics.Counter('auth_server_acl_generations_total',
+    'New ACL versions loaded', ('acl',))
+acl_read_seconds = metrics.Histogram('auth_server_acl_read_seconds',
+    'Time taken to read and parse an ACL file')
+acl_lookup_errors = metrics.Counter('auth_server_acl_lookup_errors_total',
+    'ACL lookups that failed', ('error',))
+
+# Parse the content of an ACL file into a set of integer RFIDs. Comment lines
+# (e.g. "# Generated at ...") and blank lines are ignored, as are any lines
+# that aren't valid integers.
+def parse_acl(f):
+    rfids = set()
+    for l in f:
+        l = l.strip()
+        if not l or l.startswith('#'):
+            continue
+        try:
+            rfids.add(int(l))
+        except ValueError:
+            pass
+    return frozenset(rfids)
+
+# The version of an ACL is derived from its membership only, so regenerating
+# an ACL with identical content (apart from the "Generated at" comment) does
+# not create a new version.
+def acl_version(rfids):
+    h = hashlib.sha1()
+    for rfid in sorted(rfids):
+        h.update(b'%d\n' % rfid)
+    return h.hexdigest()[:16]
+
+# One immutable generation of an ACL. Request handlers hold a reference to a
+# generation, so a concurrent reload can't change it underneath them.
+AclGeneration = collections.namedtuple('AclGeneration',
+    ('version', 'rfids', 'content', 'mtime'))
+
+# A single parsed ACL file, plus the stat() identity it was loaded from.
+class AclEntry(object):
+    def __init__(self, acl, fn):
+        self.acl = acl
+        self.fn = fn
+        self.gen = None
+        self.history = collections.deque(maxlen=history_len)
+        self.stat_key = None
+        self.last_stat_time = None
+        # Held while checking and re-reading the file, so only one thread
+        # reloads it at a time.
+        self.load_lock = threading.Lock()
+
+    # Check the file for changes, and load it if it has changed. The file is
+    # read and parsed without holding cache_lock, which is only taken to
+    # swap in the new generation, so lookups of other ACLs (and of this
+    # one, while it has a generation) never wait for the read.
+    def refresh(self, now, cache_lock):
+        if (self.gen is not None and self.last_stat_time is not None and
+                now < self.last_stat_time + stat_interval):
+            return False
+        # Until the first load completes, there's nothing to answer from, so
+        # wait for it.
+        if not self.load_lock.acquire(self.gen is None):
+            return False
+        try:
+            if (self.gen is not None and self.last_stat_time is not None and
+                    now < self.last_stat_time + stat_interval):
+                return False
+            st = os.stat(self.fn)
+            self.last_stat_time = now
+            # generate-acls-WA.py replaces ACL files via rename(), so any new
+            # generation shows up as a new inode, even if the mtime
+            # resolution is too coarse to notice.
+            stat_key = (st.st_ino, st.st_mtime_ns, st.st_size)
+            if stat_key == self.stat_key:
+                return False
+            read_start = time.monotonic()
+            with open(self.fn, 'rt') as f:
+                content = f.read()
+            rfids = parse_acl(content.splitlines())
+            version = acl_version(rfids)
+            acl_read_seconds.observe(time.monotonic() - read_start)
+            acl_reads.inc((self.acl,))
+            with cache_lock:
+                self.stat_key = stat_key
+                if self.gen and self.gen.version == version:
+                    self.gen = self.gen._replace(content=content)
+                    return False
+                if self.gen:
+                    self.history.append(self.gen)
+                self.gen = AclGeneration(version, rfids, content, st.st_mtime)
+            acl_generations.inc((self.acl,))
+            return True
+        finally:
+            self.load_lock.release()
+
+    # Find an earlier generation by version, if it's still in the history.
+    def find_gen(self, version):
+        for gen in self.history:
+            if gen.version == version:
+                return gen
+        return None
+
+# In-memory index of all ACLs that have been queried so far. Each ACL is
+# re-read only when its file changes, so a lookup is normally a single set
+# membership test with no file I/O. The lock only guards the index itself
+# and generation swaps; files are read outside it.
+class AclCache(object):
+    def __init__(self, fn_func):
+        self.fn_func = fn_func
+        self.entries = {}
+        self.lock = threading.RLock()
+        # Notified whenever any ACL gets a new generation. change_count
+        # counts notifications, so waiters can tell whether they missed one.
+        self.changed = threading.Condition(self.lock)
+        self.change_count = 0
+        self.stopping = False
+
+    def notify_change(self):
+        with self.lock:
+            self.change_count += 1
+            self.changed.notify_all()
+
+    # Make all current and future wait_for_change() calls return at once.
+    def stop_waiters(self):
+        with self.lock:
+            self.stopping = True
+            self.changed.notify_all()
+
+    # Check all loaded ACLs for changes every stat_interval seconds, so that
+    # waiters are woken promptly even if no lookups are happening.
+    def start_watcher(self):
+        thread = threading.Thread(target=self.watcher_threadfunc)
+        thread.daemon = True
+        thread.start()
+
+    def watcher_threadfunc(self):
+        while True:
+            time.sleep(stat_interval)
+            with self.lock:
+                acls = list(self.entries)
+            for acl in acls:
+                try:
+                    self.get(acl)
+                except Exception:
+                    # The ACL was deleted; wake waiters so they notice.
+                    self.notify_change()
+
+    # Wait until the version of any of the given ACLs differs from the one
+    # given, or until timeout. Returns {acl: current version} for the ACLs
+    # that changed, which is empty on timeout.
+    def wait_for_change(self, versions, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.lock:
+                seen = self.change_count
+            changed = {}
+            for (acl, version) in versions.items():
+                gen = self.get(acl)
+                if gen.version != version:
+                    changed[acl] = gen.version
+            remaining = deadline - time.monotonic()
+            if changed or remaining <= 0 or self.stopping:
+                return changed
+            with self.lock:
+                if self.change_count == seen and not self.stopping:
+                    self.changed.wait(remaining)
+
+    def get(self, acl):
+        now = time.monotonic()
+        try:
+            with self.lock:
+                entry = self.entries.get(acl)
+                if entry is None:
+                    entry = self.entries[acl] = AclEntry(acl,
+                        self.fn_func(acl))
+            try:
+                if entry.refresh(now, self.lock):
+                    self.notify_change()
+            except FileNotFoundError:
+                with self.lock:
+                    if self.entries.get(acl) is entry:
+                        del self.entries[acl]
+                raise
+        except Exception as e:
+            acl_lookup_errors.inc((type(e).__name__,))
+            raise
+        return entry.gen
+
+    # Return {acl: seconds since the current generation was written}.
+    def ages(self):
+        now = time.time()
+        with self.lock:
+            return dict(((acl,), now - entry.gen.mtime)
+                for (acl, entry) in self.entries.items()
+                if entry.gen is not None)
+
+    # Return (current generation, added RFIDs, removed RFIDs) relative to
+    # an earlier version. The sets are None if that version is unknown.
+    def get_delta(self, acl, since):
+        gen = self.get(acl)
+        with self.lock:
+            entry = self.entries.get(acl)
+            if entry is not None:
+                # The generation and history are consistent under the lock.
+                gen = entry.gen
+                old_gen = entry.find_gen(since)
+            else:
+                old_gen = None
+        if old_gen is None:
+            return (gen, None, None)
+        return (gen, gen.rfids - old_gen.rfids, old_gen.rfids - gen.rfids)
+
+    def check(self, acl, rfid):
+        try:
+            rfid = int(rfid)
+        except ValueError:
+            return False
+        return rfid in self.get(acl).rfids
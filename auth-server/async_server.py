@@ -0,0 +1,260 @@
+from __future__ import print_function
+
+import asyncio
+import concurrent.futures
+import email.utils
+import io
+import signal
+import sys
+import traceback
+import urllib.parse
+
+# Maximum size of a request's headers and body.
+max_header_bytes = 16384
+max_body_bytes = 1048576
+
+status_reasons = {
+    400: 'Bad Request',
+    413: 'Payload Too Large',
+    501: 'Not Implemented',
+    503: 'Service Unavailable',
+}
+
+class BadRequest(Exception):
+    def __init__(self, status):
+        super(BadRequest, self).__init__(status)
+        self.status = status
+
+# Run a WSGI application to completion, collecting its whole response. This
+# runs on a worker thread, so the application may block (on file I/O,
+# waiting for log writes, etc.) without stalling the event loop.
+def run_wsgi(app, environ):
+    response = []
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+    body = app(environ, start_response)
+    try:
+        data = b''.join(body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return (response[0], response[1], data)
+
+# A minimal HTTP/1.1 server built on asyncio, serving a WSGI application.
+# The event loop only parses requests and writes responses; the application
+# itself runs on a pool of worker threads. Connections are kept alive
+# between requests, so many door controllers can each hold a connection
+# open, and a slow request only occupies one worker thread. Requests for
+# long_paths (e.g. long-polls) run on a separate pool of long_threads
+# workers, so however many of them are waiting, other requests never queue
+# behind them.
+class AsyncWsgiServer(object):
+    def __init__(self, app, host, port, threads=8, keepalive_timeout=60.0,
+            request_timeout=30.0, on_stop=None, long_paths=(),
+            long_threads=8):
+        self.app = app
+        self.on_stop = on_stop
+        self.host = host
+        self.port = port
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = request_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(threads)
+        self.long_paths = frozenset(long_paths)
+        self.long_executor = concurrent.futures.ThreadPoolExecutor(
+            long_threads)
+        # Tasks handling each open connection, and those of them waiting for
+        # the next request on a kept-alive connection
+        self.connections = set()
+        self.idle_connections = set()
+        self.stopping = False
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        # Exit cleanly on SIGTERM (e.g. systemctl stop), so that atexit
+        # handlers get to flush the access log.
+        loop = asyncio.get_running_loop()
+        stop = loop.create_future()
+        loop.add_signal_handler(signal.SIGTERM, stop.set_result, None)
+        server = await asyncio.start_server(self.handle_connection,
+            self.host, self.port, limit=max_header_bytes)
+        await stop
+        server.close()
+        self.stopping = True
+        # Let the application wake any long-running handlers (long-polls),
+        # drop idle kept-alive connections, and give requests in progress
+        # until request_timeout to finish. This has to happen before
+        # wait_closed(), which (since Python 3.12) waits for every
+        # connection to close.
+        if self.on_stop:
+            self.on_stop()
+        for task in list(self.idle_connections):
+            task.cancel()
+        if self.connections:
+            (done, pending) = await asyncio.wait(self.connections,
+                timeout=self.request_timeout)
+            for task in pending:
+                task.cancel()
+        await server.wait_closed()
+        self.executor.shutdown(wait=False)
+        self.long_executor.shutdown(wait=False)
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        try:
+            keep_alive = True
+            while keep_alive and not self.stopping:
+                self.idle_connections.add(task)
+                try:
+                    head = await asyncio.wait_for(
+                        reader.readuntil(b'\r\n\r\n'), self.keepalive_timeout)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        ConnectionError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.send_error(writer, 400)
+                    break
+                finally:
+                    self.idle_connections.discard(task)
+                try:
+                    (environ, keep_alive) = self.parse_head(head, writer)
+                    environ['wsgi.input'] = io.BytesIO(
+                        await self.read_body(reader, environ))
+                except BadRequest as e:
+                    await self.send_error(writer, e.status)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError,
+                        ConnectionError):
+                    # The client stalled or went away partway through the
+                    # body.
+                    break
+                keep_alive = await self.handle_request(environ, writer,
+                    keep_alive)
+        except asyncio.CancelledError:
+            # Server shutdown; just drop the connection.
+            pass
+        except:
+            print('EXCEPTION in HTTP connection (squashed):', file=sys.stderr)
+            traceback.print_exc()
+        finally:
+            self.idle_connections.discard(task)
+            self.connections.discard(task)
+            writer.close()
+
+    def parse_head(self, head, writer):
+        lines = head.decode('latin-1').split('\r\n')
+        try:
+            (method, target, version) = lines[0].split(' ')
+        except ValueError:
+            raise BadRequest(400)
+        if not version.startswith('HTTP/1.'):
+            raise BadRequest(400)
+        (path, _, query) = target.partition('?')
+        sockname = writer.get_extra_info('sockname')
+        peername = writer.get_extra_info('peername')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.parse.unquote(path, 'latin-1'),
+            'QUERY_STRING': query,
+            'SERVER_NAME': str(sockname[0]),
+            'SERVER_PORT': str(sockname[1]),
+            'SERVER_PROTOCOL': version,
+            'REMOTE_ADDR': str(peername[0]),
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        for l in lines[1:]:
+            if not l:
+                continue
+            (name, sep, value) = l.partition(':')
+            if not sep:
+                raise BadRequest(400)
+            name = name.strip().upper().replace('-', '_')
+            value = value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                key = 'HTTP_' + name
+                if key in environ:
+                    environ[key] += ',' + value
+                else:
+                    environ[key] = value
+        if 'HTTP_TRANSFER_ENCODING' in environ:
+            raise BadRequest(501)
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        if version == 'HTTP/1.0':
+            keep_alive = 'keep-alive' in connection
+        else:
+            keep_alive = 'close' not in connection
+        return (environ, keep_alive)
+
+    async def read_body(self, reader, environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise BadRequest(400)
+        if length < 0:
+            raise BadRequest(400)
+        if length > max_body_bytes:
+            raise BadRequest(413)
+        if not length:
+            return b''
+        return await asyncio.wait_for(reader.readexactly(length),
+            self.request_timeout)
+
+    async def handle_request(self, environ, writer, keep_alive):
+        loop = asyncio.get_running_loop()
+        if environ['PATH_INFO'] in self.long_paths:
+            executor = self.long_executor
+        else:
+            executor = self.executor
+        future = loop.run_in_executor(executor, run_wsgi, self.app, environ)
+        try:
+            (status, headers, data) = await asyncio.wait_for(future,
+                self.request_timeout)
+        except asyncio.TimeoutError:
+            await self.send_error(writer, 503)
+            return False
+        except asyncio.CancelledError:
+            raise
+        except:
+            print('EXCEPTION in WSGI application (squashed):', file=sys.stderr)
+            traceback.print_exc()
+            await self.send_error(writer, 500)
+            return False
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            data = b''
+        # Tell the client not to reuse the connection if we're shutting down.
+        keep_alive = keep_alive and not self.stopping
+        await self.send_response(writer, status, headers, data, keep_alive)
+        return keep_alive
+
+    async def send_response(self, writer, status, headers, data, keep_alive):
+        header_names = set(name.lower() for (name, value) in headers)
+        headers = list(headers)
+        if 'content-length' not in header_names:
+            headers.append(('Content-Length', str(len(data))))
+        headers.append(('Date', email.utils.formatdate(usegmt=True)))
+        if not keep_alive:
+            headers.append(('Connection', 'close'))
+        head = 'HTTP/1.1 %s\r\n' % status
+        head += ''.join('%s: %s\r\n' % header for header in headers)
+        head += '\r\n'
+        writer.write(head.encode('latin-1') + data)
+        await writer.drain()
+
+    async def send_error(self, writer, status):
+        reason = status_reasons.get(status, 'Internal Server Error')
+        try:
+            await self.send_response(writer, '%d %s' % (status, reason),
+                [('Content-Type', 'text/plain')],
+                (reason + '\n').encode('utf-8'), False)
+        except ConnectionError:
+            pass
@@ -1,29 +1,67 @@
 from __future__ import print_function
 
+import atexit
+try:
+    import configparser
+except:
+    import ConfigParser as configparser
 import flask
 import os
 import re
 import time
 import subprocess
+import threading
+
+import access_index
+import async_server
+import access_log
+import acl_cache
+import log_archive
+import log_view
+import metrics
 
 auth_server_dir = os.path.dirname(__file__)
 app_dir = os.path.dirname(auth_server_dir)
 bin_dir = os.path.join(app_dir, 'bin')
+etc_dir = os.path.join(app_dir, 'etc')
+
+# AUTH_SERVER_CONF allows running against a different configuration, e.g.
+# for benchmarking against synthetic ACLs (see bin/bench-auth-server.py).
+config = configparser.ConfigParser(inline_comment_prefixes=('#'))
+config.read(os.environ.get('AUTH_SERVER_CONF',
+    os.path.join(etc_dir, 'auth-server.ini')))
+if 'auth-server' not in config:
+    config['auth-server'] = {}
+conf = config['auth-server']
+
 update_acls_bin = os.path.join(bin_dir, 'generate-acls.sh')
-acl_dir = os.path.join(app_dir, 'var', 'acls')
+acl_dir = conf.get('acl_dir', os.path.join(app_dir, 'var', 'acls'))
 acl_fn_prefix = 'acl-'
-log_dir = os.path.join(app_dir, 'var', 'log')
+log_dir = conf.get('log_dir', os.path.join(app_dir, 'var', 'log'))
 access_log_fn_template = os.path.join(log_dir, 'access-%Y-%m.log')
+access_log_glob = os.path.join(log_dir, 'access-*.log')
+access_index_fn = os.path.join(log_dir, 'access-index.sqlite')
 access_log_ts_template = '%Y%m%dT%H%M%S.'
 acl_update_log_fn = os.path.join(log_dir, 'acl-update.log')
 
 re_acl_name = re.compile('^[a-z0-9_.-]+$')
+re_month = re.compile('^([0-9]{4})-([0-9]{2})$')
+re_log_ts = re.compile('^[0-9]{8}T[0-9]{6}\\.[0-9]+$')
+re_rfid = re.compile('^[0-9]+$')
+re_record_id = re.compile('^[0-9a-zA-Z._-]+$')
+
+long_poll_timeout = conf.getfloat('long_poll_timeout', 25.0)
+long_poll_max_waiters = conf.getint('long_poll_max_waiters', 32)
+long_poll_slots = threading.BoundedSemaphore(long_poll_max_waiters)
 
 def acl_fn(acl):
     if not re_acl_name.match(acl):
         raise Exception('Invalid ACL ID', acl)
     return os.path.join(acl_dir, acl_fn_prefix + acl)
 
+acls = acl_cache.AclCache(acl_fn)
+acls.start_watcher()
+
 def show_file(fn, template, **extra):
     try:
         with open(fn, 'rt') as f:
@@ -32,6 +70,22 @@ def show_file(fn, template, **extra):
         content='Could not read log file'
     return flask.render_template(template, content=content, **extra)
 
+# Render one page of a log file, newest entries first. "before" selects an
+# older page by byte offset, and "follow" turns on live tail-follow mode.
+# fn overrides the log's current file, e.g. to view an archived month.
+def show_log(log, template, fn=None, page_args='', **extra):
+    before = flask.request.args.get('before', None, type=int)
+    follow = 'follow' in flask.request.args and not fn
+    if not fn:
+        fn = logs[log]()
+    try:
+        (lines, start, end) = log_view.read_page(fn, before)
+    except:
+        (lines, start, end) = (['Could not read log file'], 0, 0)
+    return flask.render_template(template, content='\n'.join(lines),
+        log=log, log_name=os.path.basename(fn), start=start, end=end,
+        newest=(before is None), follow=follow, page_args=page_args, **extra)
+
 update_acls_popen = None
 
 def update_acls_start():
@@ -58,21 +112,90 @@ def update_acls_poll():
 def access_log_fn():
     return time.strftime(access_log_fn_template)
 
-last_ts = None
-ts_seq_num = 0
-def gen_ts():
-    global ts_seq_num
-    global last_ts
-    ts = time.strftime(access_log_ts_template)
-    if ts == last_ts:
-        ts_seq_num += 1
-    else:
-        ts_seq_num = 0
-    last_ts = ts
-    return ts + str(ts_seq_num)
+def access_log_month_fn(month):
+    m = re_month.match(month)
+    if not m:
+        raise Exception('Invalid month', month)
+    return access_log_fn_template.replace('%Y', m.group(1)).replace('%m', m.group(2))
+
+def access_log_months():
+    months = []
+    for fn in log_archive.glob_logs(access_log_glob):
+        try:
+            months.append(time.strftime('%Y-%m',
+                time.strptime(fn, access_log_fn_template)))
+        except ValueError:
+            pass
+    months.reverse()
+    return months
+
+access_log_writer = access_log.AccessLog(access_log_fn_template,
+    access_log_ts_template,
+    flush_interval=conf.getfloat('log_flush_interval', 1.0),
+    durability=conf.get('log_durability', 'flush'))
+access_log_writer.start()
+atexit.register(access_log_writer.stop)
+
+access_log_index = access_index.AccessIndex(access_index_fn, access_log_glob)
+
+logs = {
+    'access': access_log_fn,
+    'acl-update': lambda: acl_update_log_fn,
+}
+
+request_seconds = metrics.Histogram('auth_server_request_seconds',
+    'Time taken to handle a request', ('route', 'method', 'status'))
+request_errors = metrics.Counter('auth_server_request_errors_total',
+    'Requests that raised an exception', ('route',))
+check_access_seconds = metrics.Histogram('auth_server_check_access_seconds',
+    'Time taken to check access and queue the log record', ('acl',))
+access_checks = metrics.Counter('auth_server_access_checks_total',
+    'Access checks, by decision', ('acl', 'result'))
+long_polls_refused = metrics.Counter('auth_server_long_polls_refused_total',
+    'ACL change long-polls answered at once because too many were waiting')
+metrics.CallbackGauge('auth_server_acl_age_seconds',
+    'Time since the current generation of each loaded ACL was written',
+    acls.ages, ('acl',))
+metrics.CallbackGauge('auth_server_access_log_queue_depth',
+    'Batches of access log records waiting to be written',
+    lambda: {(): access_log_writer.queue.qsize()})
+
+# Label for per-ACL metrics. Names of ACLs that don't exist come from
+# clients, so they share one label instead of each adding a series.
+def acl_label(acl):
+    try:
+        acls.get(acl)
+    except Exception:
+        return 'unknown'
+    return acl
 
 app = flask.Flask(__name__)
 
+def request_route():
+    if flask.request.url_rule:
+        return flask.request.url_rule.rule
+    return 'unmatched'
+
+@app.before_request
+def metrics_before_request():
+    flask.g.request_start = time.monotonic()
+
+@app.after_request
+def metrics_after_request(resp):
+    request_seconds.observe(time.monotonic() - flask.g.request_start,
+        (request_route(), flask.request.method, resp.status_code))
+    return resp
+
+@app.teardown_request
+def metrics_teardown_request(exc):
+    if exc is not None:
+        request_errors.inc((request_route(),))
+
+@app.route('/metrics')
+def metrics_exposition():
+    return flask.Response(metrics.registry.exposition(),
+        mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
 def index():
     return flask.render_template('index.html')
@@ -89,7 +212,7 @@ def ui_update_acls():
 @app.route('/ui/view-acl-update-log')
 def ui_view_acl_update_log():
     running = update_acls_poll()
-    return show_file(acl_update_log_fn, 'ui-view-acl-update-log.html', running=running)
+    return show_log('acl-update', 'ui-view-acl-update-log.html', running=running)
 
 @app.route('/ui/view-acls')
 def ui_view_acls():
@@ -103,26 +226,218 @@ def ui_view_acl(acl):
 
 @app.route('/ui/view-access-check-log')
 def ui_view_access_check_log():
-    return show_file(access_log_fn(), 'ui-view-access-check-log.html')
+    month = flask.request.args.get('month')
+    if month:
+        return show_log('access', 'ui-view-access-check-log.html',
+            fn=access_log_month_fn(month), page_args='month=%s&' % month,
+            month=month, months=access_log_months())
+    return show_log('access', 'ui-view-access-check-log.html',
+        months=access_log_months())
+
+query_args = ('rfid', 'acl', 'result', 'start', 'end')
+
+def query_access_log():
+    args = flask.request.args
+    query = dict((k, args[k]) for k in query_args if args.get(k))
+    limit = args.get('limit', 1000, type=int)
+    return (query, access_log_index.query(limit=limit, **query))
+
+@app.route('/ui/query-access-log')
+def ui_query_access_log():
+    try:
+        (query, lines) = query_access_log()
+        content = '\n'.join(lines)
+    except ValueError as e:
+        (query, content) = ({}, 'Invalid query: ' + str(e.args[-1]))
+    return flask.render_template('ui-query-access-log.html',
+        content=content, query=query)
+
+# Query all monthly access logs. Each of rfid, acl, result, start and end
+# (inclusive start, exclusive end; e.g. 2018-01-10 or 20180110T230149) is
+# optional. Returns matching log lines, newest first, at most limit of them.
+@app.route('/api/query-access-log-0')
+def api_query_access_log_0():
+    try:
+        (query, lines) = query_access_log()
+    except ValueError as e:
+        return flask.Response('Invalid query: ' + str(e.args[-1]) + '\n',
+            status=400, mimetype='text/plain')
+    return flask.Response(''.join(l + '\n' for l in lines),
+        mimetype='text/plain')
+
+# Returns whole lines appended to a log since byte offset "offset", oldest
+# first. X-Log-Offset is the offset to pass to the next call. X-Log-Name
+# identifies the underlying file; if it differs from the "name" passed in
+# (e.g. the access log rolled over to a new month), reading restarts at the
+# beginning of the new file.
+@app.route('/api/tail-log-0/<log>')
+def api_tail_log_0(log):
+    if log not in logs:
+        flask.abort(404)
+    fn = logs[log]()
+    name = os.path.basename(fn)
+    offset = flask.request.args.get('offset', 0, type=int)
+    if flask.request.args.get('name', name) != name:
+        offset = 0
+    (lines, offset) = log_view.read_new(fn, offset)
+    resp = flask.Response(''.join(l + '\n' for l in lines),
+        mimetype='text/plain')
+    resp.headers['X-Log-Offset'] = str(offset)
+    resp.headers['X-Log-Name'] = name
+    return resp
 
 @app.route('/api/check-access-0/<acl>/<rfid>')
 def api_check_access_0(acl, rfid):
-    result = False
-    with open(acl_fn(acl), 'rt') as f:
-        for l in f.readlines():
-            if l.strip() == rfid:
-                result = True
-                break
-    with open(access_log_fn(), 'at+') as f:
-        print('%s,check,%s,%s,%s' % (gen_ts(), acl, rfid, repr(result)), file=f)
+    start = time.monotonic()
+    result = acls.check(acl, rfid)
+    access_log_writer.log_check(acl, rfid, repr(result))
+    check_access_seconds.observe(time.monotonic() - start, (acl,))
+    access_checks.inc((acl, repr(result)))
     return flask.Response(repr(result), mimetype='text/plain')
 
+# Long-poll for ACL changes. Takes one or more acl=<name>:<version>
+# parameters, and returns as soon as any of those ACLs has a different
+# version, with one "<name> <version>" line per changed ACL. Returns an empty
+# body if nothing changed within timeout seconds (capped at
+# long_poll_timeout). Once long_poll_max_waiters are waiting, further
+# long-polls are answered at once, as if timeout were 0.
+@app.route('/api/wait-acl-change-0')
+def api_wait_acl_change_0():
+    versions = {}
+    for arg in flask.request.args.getlist('acl'):
+        (acl, _, version) = arg.partition(':')
+        if not re_acl_name.match(acl):
+            flask.abort(400)
+        versions[acl] = version
+    if not versions:
+        flask.abort(400)
+    timeout = min(flask.request.args.get('timeout', long_poll_timeout, type=float),
+        long_poll_timeout)
+    waiting = long_poll_slots.acquire(blocking=False)
+    if not waiting:
+        long_polls_refused.inc()
+        timeout = 0
+    try:
+        changed = acls.wait_for_change(versions, timeout)
+    finally:
+        if waiting:
+            long_poll_slots.release()
+    content = ''.join('%s %s\n' % item for item in sorted(changed.items()))
+    return flask.Response(content, mimetype='text/plain')
+
+# Body: one "acl,rfid" pair per line.
+# Response: one "acl,rfid,result" line per pair, in the same order.
+@app.route('/api/check-access-batch-0', methods=['POST'])
+def api_check_access_batch_0():
+    pairs = []
+    for l in flask.request.get_data(as_text=True).splitlines():
+        l = l.strip()
+        if not l:
+            continue
+        fields = l.split(',')
+        if len(fields) != 2 or not re_acl_name.match(fields[0]):
+            return flask.Response('Invalid line: ' + l + '\n', status=400,
+                mimetype='text/plain')
+        pairs.append(fields)
+    checks = []
+    for (acl, rfid) in pairs:
+        label = acl
+        try:
+            result = acls.check(acl, rfid)
+        except FileNotFoundError:
+            result = False
+            label = 'unknown'
+        checks.append((acl, rfid, repr(result)))
+        access_checks.inc((label, repr(result)))
+    access_log_writer.log_checks(checks)
+    content = ''.join('%s,%s,%s\n' % check for check in checks)
+    return flask.Response(content, mimetype='text/plain')
+
 @app.route('/api/log-remote-access-check-0/<acl>/<rfid>/<result>')
 def api_log_remote_access_check_0(acl, rfid, result):
-    with open(access_log_fn(), 'at+') as f:
-        print('%s,check,%s,%s,%s' % (gen_ts(), acl, rfid, result), file=f)
+    access_log_writer.log_check(acl, rfid, result)
+    return flask.Response('OK', mimetype='text/plain')
+
+remote_record_ids = access_log.RecentIds(db_fn=access_index_fn)
 
+# Bulk version of /api/log-remote-access-check-0, for controllers that make
+# their own access decisions. Body: one "id,timestamp,acl,rfid,result" line
+# per decision, where id is unique per record and timestamp is when the
+# decision was made, in access log format. Records whose ID was already
+# received are ignored, so a batch may safely be resent, even across a
+# restart: IDs are stored once their records are written. Invalid lines are
+# skipped, so one bad record can't block a controller's spool forever.
+@app.route('/api/log-remote-access-check-batch-0', methods=['POST'])
+def api_log_remote_access_check_batch_0():
+    checks = []
+    record_ids = []
+    duplicates = 0
+    invalid = 0
+    for l in flask.request.get_data(as_text=True).splitlines():
+        fields = l.strip().split(',')
+        if (len(fields) != 5 or not re_record_id.match(fields[0]) or
+                not re_log_ts.match(fields[1]) or
+                not re_acl_name.match(fields[2]) or
+                not re_rfid.match(fields[3]) or
+                fields[4] not in ('True', 'False')):
+            invalid += 1
+            continue
+        if not remote_record_ids.add(fields[0]):
+            duplicates += 1
+            continue
+        checks.append(tuple(fields[1:]))
+        record_ids.append(fields[0])
+        access_checks.inc((acl_label(fields[2]), fields[4]))
+    access_log_writer.log_timestamped_checks(checks,
+        lambda: remote_record_ids.persist(record_ids))
+    content = 'logged %d duplicate %d invalid %d\n' % (len(checks),
+        duplicates, invalid)
+    return flask.Response(content, mimetype='text/plain')
+
+def etag_matches(if_none_match, etag):
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag in ('*', etag):
+            return True
+    return False
+
+# Returns the full ACL, with its version in the ETag header. If the client
+# already has the current version (If-None-Match or since=), returns 304. If
+# since= names an earlier version that's still known, returns just the
+# changes as "+rfid" and "-rfid" lines, with an X-ACL-Delta-Since header.
 @app.route('/api/get-acl-0/<acl>')
 def api_get_acl_0(acl):
-    with open(acl_fn(acl), 'rt') as f:
-        return flask.Response(f.read(), mimetype='text/plain')
+    since = flask.request.args.get('since')
+    (gen, added, removed) = acls.get_delta(acl, since)
+    etag = '"%s"' % gen.version
+    if_none_match = flask.request.headers.get('If-None-Match')
+    if since == gen.version or (if_none_match and
+            etag_matches(if_none_match, etag)):
+        resp = flask.Response(status=304)
+    elif added is not None:
+        content = ''.join(
+            ['+%d\n' % rfid for rfid in sorted(added)] +
+            ['-%d\n' % rfid for rfid in sorted(removed)])
+        resp = flask.Response(content, mimetype='text/plain')
+        resp.headers['X-ACL-Delta-Since'] = since
+    else:
+        resp = flask.Response(gen.content, mimetype='text/plain')
+    resp.headers['ETag'] = etag
+    return resp
+
+# Production server. "flask run" (see bin/auth-server.sh) remains usable for
+# debugging.
+if __name__ == '__main__':
+    server = async_server.AsyncWsgiServer(app,
+        conf.get('host', '0.0.0.0'),
+        conf.getint('port', 8080),
+        threads=conf.getint('threads', 16),
+        keepalive_timeout=conf.getfloat('keepalive_timeout', 60.0),
+        request_timeout=conf.getfloat('request_timeout', 30.0),
+        on_stop=acls.stop_waiters,
+        long_paths=('/api/wait-acl-change-0',),
+        # Spare threads answer long-polls refused by long_poll_slots at once.
+        long_threads=long_poll_max_waiters + 4)
+    server.run()
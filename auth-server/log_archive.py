@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import glob
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+# Archive file layout:
+# - Compressed blocks. Each holds a whole number of lines of the original
+#   log, and is compressed independently, so can be decompressed on its own.
+# - The block index, as JSON: a list of
+#   [raw_offset, raw_len, comp_offset, comp_len, min_ts, max_ts].
+#   Lines aren't always in timestamp order (records from door controllers
+#   arrive late), so these are the earliest and latest in the block, or
+#   None if any line has no timestamp.
+# - A trailer: the index's offset and length, then archive_magic.
+archive_suffix = '.zblk'
+archive_magic = b'ZBLK0001'
+trailer_fmt = '>QQ8s'
+trailer_len = struct.calcsize(trailer_fmt)
+block_size = 65536
+
+def line_ts(l):
+    # Access log lines start with "20180110T230149.0,"; other logs may not
+    # have timestamps at all.
+    ts = l[:15]
+    if len(ts) == 15 and ts[8:9] == b'T' and ts[:8].isdigit():
+        return ts.decode('ascii')
+    return None
+
+def write_archive(fn, afn):
+    index = []
+    tmp_fn = os.path.join(os.path.dirname(afn), '.' + os.path.basename(afn) + '.tmp')
+    with open(fn, 'rb') as f, open(tmp_fn, 'wb') as af:
+        raw_offset = 0
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            # Extend the block to the end of its last line.
+            if not block.endswith(b'\n'):
+                block += f.readline()
+            stamps = [line_ts(l) for l in block.splitlines()]
+            if None in stamps:
+                (min_ts, max_ts) = (None, None)
+            else:
+                (min_ts, max_ts) = (min(stamps), max(stamps))
+            comp = zlib.compress(block, 9)
+            index.append([raw_offset, len(block), af.tell(), len(comp),
+                min_ts, max_ts])
+            af.write(comp)
+            raw_offset += len(block)
+        index_data = json.dumps(index).encode('utf-8')
+        index_offset = af.tell()
+        af.write(index_data)
+        af.write(struct.pack(trailer_fmt, index_offset, len(index_data),
+            archive_magic))
+        af.flush()
+        os.fsync(af.fileno())
+    os.rename(tmp_fn, afn)
+
+# Replace a log file with a compressed archive.
+def archive_log(fn):
+    write_archive(fn, fn + archive_suffix)
+    os.unlink(fn)
+
+# Read access to an uncompressed log file.
+class PlainLog(object):
+    def __init__(self, fn):
+        self.f = open(fn, 'rb')
+        self.size = self.f.seek(0, os.SEEK_END)
+
+    def read(self, offset, length):
+        self.f.seek(offset)
+        return self.f.read(length)
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Read access to an archived log file, using offsets within the original
+# uncompressed file. Only the blocks covering the requested range are read
+# and decompressed.
+class LogArchive(object):
+    def __init__(self, fn):
+        self.f = open(fn, 'rb')
+        try:
+            self.f.seek(-trailer_len, os.SEEK_END)
+            (index_offset, index_len, magic) = struct.unpack(trailer_fmt,
+                self.f.read(trailer_len))
+            if magic != archive_magic:
+                raise Exception('Invalid log archive', fn)
+            self.f.seek(index_offset)
+            self.index = json.loads(self.f.read(index_len).decode('utf-8'))
+        except:
+            self.f.close()
+            raise
+        self.raw_offsets = [block[0] for block in self.index]
+        if self.index:
+            self.size = self.index[-1][0] + self.index[-1][1]
+        else:
+            self.size = 0
+        self.cached_block_num = None
+        self.cached_block = None
+
+    def read_block(self, block_num):
+        if block_num != self.cached_block_num:
+            (raw_offset, raw_len, comp_offset, comp_len) = \
+                self.index[block_num][:4]
+            self.f.seek(comp_offset)
+            self.cached_block = zlib.decompress(self.f.read(comp_len))
+            self.cached_block_num = block_num
+        return self.cached_block
+
+    def read(self, offset, length):
+        end = min(offset + length, self.size)
+        data = []
+        block_num = bisect.bisect_right(self.raw_offsets, offset) - 1
+        while offset < end:
+            block = self.read_block(block_num)
+            block_offset = self.raw_offsets[block_num]
+            chunk = block[offset - block_offset:end - block_offset]
+            data.append(chunk)
+            offset += len(chunk)
+            block_num += 1
+        return b''.join(data)
+
+    # Return the lines with timestamps in [start, end), in log order. Blocks
+    # known to lie wholly outside the range aren't decompressed.
+    def read_ts_range(self, start=None, end=None):
+        lines = []
+        for (block_num, block) in enumerate(self.index):
+            (min_ts, max_ts) = block[4:6]
+            if start is not None and max_ts is not None and max_ts < start:
+                continue
+            if end is not None and min_ts is not None and min_ts >= end:
+                continue
+            for l in self.read_block(block_num).splitlines():
+                ts = line_ts(l)
+                if start is not None and ts is not None and ts < start:
+                    continue
+                if end is not None and ts is not None and ts >= end:
+                    continue
+                lines.append(l)
+        return lines
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Open a log file by its original name, whether or not it's been archived.
+def open_log(fn):
+    try:
+        return PlainLog(fn)
+    except FileNotFoundError:
+        return LogArchive(fn + archive_suffix)
+
+# Name of a log file, whether it's the original or an archive.
+def log_name(fn):
+    if fn.endswith(archive_suffix):
+        return fn[:-len(archive_suffix)]
+    return fn
+
+# Find logs matching a pattern, whether or not they've been archived.
+def glob_logs(pattern):
+    fns = glob.glob(pattern) + glob.glob(pattern + archive_suffix)
+    return sorted(set(log_name(fn) for fn in fns))
+
+# Archive all monthly logs (e.g. access-2018-01.log) for months before the
+# current one, and delete archives older than keep_months months.
+def archive_monthly_logs(template, keep_months=None, verbose=False):
+    now = time.localtime()
+    this_month = now.tm_year * 12 + now.tm_mon - 1
+    glob_pattern = template.replace('%Y', '[0-9]' * 4).replace('%m', '[0-9]' * 2)
+    for fn in glob_logs(glob_pattern):
+        month_tm = time.strptime(fn, template)
+        month = month_tm.tm_year * 12 + month_tm.tm_mon - 1
+        if month >= this_month:
+            continue
+        if os.path.exists(fn):
+            if verbose:
+                print('Archiving', fn)
+            archive_log(fn)
+        if keep_months is not None and month < this_month - keep_months:
+            if verbose:
+                print('Deleting', fn + archive_suffix)
+            os.unlink(fn + archive_suffix)
+
+if __name__ == '__main__':
+    auth_server_dir = os.path.dirname(os.path.abspath(__file__))
+    log_dir = os.path.join(os.path.dirname(auth_server_dir), 'var', 'log')
+    parser = argparse.ArgumentParser(
+        description='Archive closed months of access logs, or read archives')
+    subparsers = parser.add_subparsers(dest='cmd')
+    parser_archive = subparsers.add_parser('archive',
+        help='Archive access logs for previous months')
+    parser_archive.add_argument('--keep-months', type=int,
+        help='Delete archives more than this many months old')
+    parser_archive.add_argument('--verbose', action='store_true')
+    parser_cat = subparsers.add_parser('cat',
+        help='Print lines from a log, with timestamps in [start, end)')
+    parser_cat.add_argument('log')
+    parser_cat.add_argument('start', nargs='?')
+    parser_cat.add_argument('end', nargs='?')
+    args = parser.parse_args()
+    if args.cmd == 'archive':
+        archive_monthly_logs(os.path.join(log_dir, 'access-%Y-%m.log'),
+            args.keep_months, args.verbose)
+    elif args.cmd == 'cat':
+        with LogArchive(log_name(args.log) + archive_suffix) as la:
+            for l in la.read_ts_range(args.start, args.end):
+                sys.stdout.buffer.write(l + b'\n')
+    else:
+        parser.print_help()
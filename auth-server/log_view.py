@@ -0,0 +1,49 @@
+from __future__ import print_function
+
+import log_archive
+
+# Amount of log shown on one page of a log viewer.
+page_bytes = 16384
+
+# Maximum amount of new log data returned by one tail-follow poll.
+tail_bytes = 65536
+
+# Read the page of a log file that ends at byte offset "before" (or at the
+# end of the file), trimmed to whole lines. Only the bytes on the page are
+# read (for archived logs, only the blocks containing them are decompressed).
+# Returns (lines newest first, page start offset, page end offset).
+def read_page(fn, before=None):
+    with log_archive.open_log(fn) as f:
+        if before is None or before > f.size:
+            end = f.size
+        else:
+            end = max(0, before)
+        start = max(0, end - page_bytes)
+        data = f.read(start, end - start)
+        size = f.size
+    if end < size and not data.endswith(b'\n'):
+        data = data[:data.rfind(b'\n') + 1]
+    if start > 0:
+        nl = data.find(b'\n')
+        # A line longer than a page is shown truncated rather than skipped.
+        if nl != -1 and nl + 1 < len(data):
+            start += nl + 1
+            data = data[nl + 1:]
+    lines = data.decode('utf-8', 'replace').splitlines()
+    lines.reverse()
+    return (lines, start, end)
+
+# Read whole lines appended to a log file since byte offset "offset". If the
+# file has shrunk (it was rewritten), or the offset is invalid, reading
+# restarts at the beginning.
+# Returns (lines oldest first, new offset).
+def read_new(fn, offset):
+    try:
+        with log_archive.open_log(fn) as f:
+            if offset > f.size or offset < 0:
+                offset = 0
+            data = f.read(offset, min(f.size - offset, tail_bytes))
+    except FileNotFoundError:
+        return ([], 0)
+    data = data[:data.rfind(b'\n') + 1]
+    return (data.decode('utf-8', 'replace').splitlines(), offset + len(data))
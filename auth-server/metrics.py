@@ -0,0 +1,126 @@
+from __future__ import print_function
+
+import bisect
+import threading
+
+# Simple thread-safe counters, gauges and histograms, rendered in the
+# Prometheus plain-text exposition format. Updating a metric costs one short
+# lock hold and a dict lookup, so they can be used on the request path.
+
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def escape_label_value(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (n, escape_label_value(v))
+        for (n, v) in pairs) + '}'
+
+def format_value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return repr(float(v))
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.samples())
+        return ''.join(l + '\n' for l in lines)
+
+registry = Registry()
+
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, label_values=(), n=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + n
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, format_labels(self.labels, lv),
+            format_value(v)) for (lv, v) in values]
+
+# A gauge whose values are computed when metrics are collected. func
+# returns a dict mapping label value tuples to values.
+class CallbackGauge(object):
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labels=(), registry=registry):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = labels
+        registry.register(self)
+
+    def samples(self):
+        return ['%s%s %s' % (self.name, format_labels(self.labels, lv),
+            format_value(v)) for (lv, v) in sorted(self.func().items())]
+
+class Histogram(object):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets,
+            registry=registry):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (non-cumulative), +Inf count, sum]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, label_values=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            v = self.values.get(label_values)
+            if v is None:
+                v = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[label_values] = v
+            v[i] += 1
+            v[-1] += value
+
+    def samples(self):
+        with self.lock:
+            values = sorted((lv, list(v)) for (lv, v) in self.values.items())
+        samples = []
+        for (lv, v) in values:
+            cumulative = 0
+            for (i, le) in enumerate(self.buckets + (float('inf'),)):
+                cumulative += v[i]
+                samples.append('%s_bucket%s %d' % (self.name,
+                    format_labels(self.labels, lv, (('le', format_value(le)),)),
+                    cumulative))
+            samples.append('%s_sum%s %s' % (self.name,
+                format_labels(self.labels, lv), format_value(v[-1])))
+            samples.append('%s_count%s %d' % (self.name,
+                format_labels(self.labels, lv), cumulative))
+        return samples
@@ -9,6 +9,8 @@ export LC_ALL=C.UTF-8
 export LANG=C.UTF-8
 
 . "${app_dir}/venv/bin/activate"
-export FLASK_APP="${app_dir}/auth-server/auth-server.py"
+# For debugging with the Flask development server instead:
+#export FLASK_APP="${app_dir}/auth-server/auth-server.py"
 #export FLASK_DEBUG=1
-exec flask run --host=0.0.0.0 --port=8080
+#exec flask run --host=0.0.0.0 --port=8080
+exec python "${app_dir}/auth-server/auth-server.py"
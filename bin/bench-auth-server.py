@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+
+import argparse
+import http.client
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+bin_dir = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.dirname(bin_dir)
+auth_server_py = os.path.join(app_dir, 'auth-server', 'auth-server.py')
+
+def make_acls(acl_dir, num_acls, num_rfids):
+    """Writes num_acls synthetic ACL files, each holding num_rfids RFIDs,
+    in the same format as generate-acls-WA.py.
+
+    Returns: dict mapping ACL name to list of RFIDs
+    """
+    acls = {}
+    for i in range(num_acls):
+        name = 'bench-%d' % i
+        rfids = sorted(set(random.randrange(10 ** 10)
+            for _ in range(num_rfids)))
+        with open(os.path.join(acl_dir, 'acl-' + name), 'w') as f:
+            print('# Generated at', time.strftime('%Y%m%dT%H%M%S'), file=f)
+            f.write(''.join('%d\n' % rfid for rfid in rfids))
+        acls[name] = rfids
+    return acls
+
+def check_paths(acls, count, hit_ratio):
+    """Generates check-access request paths, of which about hit_ratio
+    are for RFIDs in the ACL.
+
+    Returns: list of paths
+    """
+    names = list(acls)
+    paths = []
+    for _ in range(count):
+        name = random.choice(names)
+        if random.random() < hit_ratio:
+            rfid = random.choice(acls[name])
+        else:
+            rfid = random.randrange(10 ** 10)
+        paths.append('/api/check-access-0/%s/%d' % (name, rfid))
+    return paths
+
+def replay_paths(log_fns, acl_names):
+    """Converts the check records in access log files into check-access
+    request paths. ACLs are mapped round-robin onto the synthetic ACLs.
+
+    Returns: list of paths
+    """
+    acl_map = {}
+    paths = []
+    for fn in log_fns:
+        with open(fn, 'rt') as f:
+            for l in f:
+                fields = l.strip().split(',')
+                if len(fields) != 5 or fields[1] != 'check':
+                    continue
+                acl = fields[2]
+                if acl not in acl_map:
+                    acl_map[acl] = acl_names[len(acl_map) % len(acl_names)]
+                paths.append('/api/check-access-0/%s/%s' % (acl_map[acl],
+                    fields[3]))
+    return paths
+
+def write_conf(conf_fn, tmp_dir, port):
+    with open(conf_fn, 'w') as f:
+        print('[auth-server]', file=f)
+        print('host=127.0.0.1', file=f)
+        print('port=%d' % port, file=f)
+        print('acl_dir=%s' % os.path.join(tmp_dir, 'acls'), file=f)
+        print('log_dir=%s' % os.path.join(tmp_dir, 'log'), file=f)
+
+def wait_for_server(port, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1.0)
+            conn.request('GET', '/metrics')
+            conn.getresponse().read()
+            conn.close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise Exception('Auth server did not start')
+            time.sleep(0.1)
+
+def rss_kb(pid):
+    """Returns: (current RSS, peak RSS) of a process, in kB"""
+    vals = {}
+    with open('/proc/%d/status' % pid) as f:
+        for l in f:
+            (name, _, value) = l.partition(':')
+            if name in ('VmRSS', 'VmHWM'):
+                vals[name] = int(value.split()[0])
+    return (vals.get('VmRSS'), vals.get('VmHWM'))
+
+def run_load(port, paths, concurrency):
+    """Sends all paths using concurrency keep-alive connections.
+
+    Returns: (list of latencies in seconds, error count, elapsed seconds)
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    def worker(worker_paths):
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30.0)
+        local_latencies = []
+        local_errors = 0
+        for path in worker_paths:
+            start = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.status != 200:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port,
+                    timeout=30.0)
+            local_latencies.append(time.perf_counter() - start)
+        conn.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+    threads = [threading.Thread(target=worker, args=(paths[i::concurrency],))
+        for i in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return (latencies, errors[0], time.perf_counter() - start)
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float('nan')
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * p))]
+
+def report(name, latencies, errors, elapsed, rss):
+    latencies.sort()
+    print('%-12s %8d reqs %6d errs %9.1f req/s  p50 %7.2f ms  p99 %7.2f ms  '
+        'max %7.2f ms  RSS %d kB (peak %d kB)' % (
+        name, len(latencies), errors, len(latencies) / elapsed,
+        percentile(latencies, 0.50) * 1000,
+        percentile(latencies, 0.99) * 1000,
+        latencies[-1] * 1000 if latencies else float('nan'),
+        rss[0], rss[1]))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark auth-server.py against synthetic ACLs')
+    parser.add_argument('--acls', type=int, default=24,
+        help='Number of synthetic ACLs')
+    parser.add_argument('--rfids', type=int, default=10000,
+        help='Number of RFIDs in each ACL')
+    parser.add_argument('--concurrency', type=int, default=8,
+        help='Number of concurrent client connections')
+    parser.add_argument('--requests', type=int, default=20000,
+        help='Number of check-access requests')
+    parser.add_argument('--get-acl-requests', type=int, default=100,
+        help='Number of get-acl requests')
+    parser.add_argument('--hit-ratio', type=float, default=0.5,
+        help='Fraction of check-access requests for RFIDs in the ACL')
+    parser.add_argument('--replay', nargs='+', metavar='LOG',
+        help='Replay check records from access-*.log files instead of '
+        'generating random check-access requests')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--keep', action='store_true',
+        help='Keep the synthetic ACL and log directory')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench-auth-server-')
+    os.mkdir(os.path.join(tmp_dir, 'acls'))
+    os.mkdir(os.path.join(tmp_dir, 'log'))
+    conf_fn = os.path.join(tmp_dir, 'auth-server.ini')
+    write_conf(conf_fn, tmp_dir, args.port)
+
+    print('Generating %d ACLs of %d RFIDs in %s' % (args.acls, args.rfids,
+        tmp_dir))
+    sys.stdout.flush()
+    acls = make_acls(os.path.join(tmp_dir, 'acls'), args.acls, args.rfids)
+    if args.replay:
+        paths = replay_paths(args.replay, sorted(acls))
+    else:
+        paths = check_paths(acls, args.requests, args.hit_ratio)
+    get_acl_paths = ['/api/get-acl-0/' + random.choice(list(acls))
+        for _ in range(args.get_acl_requests)]
+
+    env = dict(os.environ)
+    env['AUTH_SERVER_CONF'] = conf_fn
+    server = subprocess.Popen([sys.executable, auth_server_py], env=env)
+    try:
+        wait_for_server(args.port)
+        print('Server started; RSS %d kB' % rss_kb(server.pid)[0])
+
+        # Load every ACL once, so the first-touch parse isn't measured.
+        (latencies, errors, elapsed) = run_load(args.port,
+            ['/api/check-access-0/%s/0' % name for name in acls], 1)
+        report('warmup', latencies, errors, elapsed, rss_kb(server.pid))
+
+        (latencies, errors, elapsed) = run_load(args.port, paths,
+            args.concurrency)
+        report('check-access', latencies, errors, elapsed, rss_kb(server.pid))
+
+        if get_acl_paths:
+            (latencies, errors, elapsed) = run_load(args.port, get_acl_paths,
+                args.concurrency)
+            report('get-acl', latencies, errors, elapsed, rss_kb(server.pid))
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+        if not args.keep:
+            shutil.rmtree(tmp_dir)
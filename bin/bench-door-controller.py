@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import argparse
+import configparser
+import importlib.util
+import itertools
+import os
+import pty
+import random
+import sys
+import threading
+import time
+
+bin_dir = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.dirname(bin_dir)
+door_controller_dir = os.path.join(app_dir, 'door-controller')
+sys.path.insert(0, door_controller_dir)
+
+import sim_gpio
+
+def load_door_controller(verbose):
+    spec = importlib.util.spec_from_file_location('door_controller',
+        os.path.join(door_controller_dir, 'door-controller.py'))
+    dc = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(dc)
+    # Use the simulated GPIO even on a Raspberry Pi.
+    dc.GPIO = sim_gpio
+    sim_gpio.verbose = verbose
+    sim_gpio.recording = True
+    if not verbose:
+        dc.print_with_timestamp = lambda s: None
+    return dc
+
+def make_config(num_readers, sleeps):
+    """Returns: list of config sections, one per reader, each driving two
+    pins of its own with an authorized sequence that alternately sets them,
+    separated by the given sleeps.
+    """
+    config = configparser.ConfigParser()
+    for i in range(num_readers):
+        pins = (3 + 2 * i, 4 + 2 * i)
+        (master, slave) = pty.openpty()
+        sec = {
+            'reader_type': 'parallax',
+            'serial_port': os.ttyname(slave),
+            'auth_host': '127.0.0.1',
+            'auth_port': '1',
+            'acl': 'bench',
+            'restart_action': 'True',
+        }
+        for (j, pin) in enumerate(pins):
+            sec['init.%d' % (2 * j)] = 'gpio.setup.out,%d' % pin
+            sec['init.%d' % (2 * j + 1)] = 'gpio.out,%d,0' % pin
+        steps = []
+        for k in range(len(sleeps) + 1):
+            steps.append('gpio.out,%d,%d' % (pins[k % 2], 1 - (k // 2) % 2))
+            if k < len(sleeps):
+                steps.append('sleep,%s' % sleeps[k])
+        for (j, step) in enumerate(steps):
+            sec['authorized.%d' % j] = step
+        config['conf.bench.%d' % i] = sec
+    return [config[name] for name in config.sections()]
+
+def reader_pins(reader):
+    return reader.setup_pins
+
+def output_offsets(reader):
+    """Returns: list of offsets from sequence start of each pin write in
+    the reader's authorized sequence"""
+    offsets = []
+    for (offset, step) in reader.authorized_plan:
+        offsets.extend([offset] * len(getattr(step, 'gpios', ())))
+    return offsets
+
+def outputs_between(outputs, pins, start, end):
+    return [(t, c, v) for (t, c, v) in outputs
+        if c in pins and start <= t < end]
+
+def first_output(outputs, pin, value, after):
+    for (t, c, v) in outputs:
+        if t >= after and c == pin and v == value:
+            return t
+    return None
+
+def burn_cpu(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+def run_swipes(readers, func, args):
+    threads = [threading.Thread(target=func, args=(reader,) + args)
+        for reader in readers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+tag_ids = itertools.count(1)
+
+def swipe(reader):
+    t = time.monotonic()
+    reader.handle_tag(next(tag_ids), t)
+    return t
+
+def first_pin(reader):
+    return reader.authorized_plan[0][1].gpios[0]
+
+# Returns once the reader's authorized sequence has started since time t.
+def wait_for_start(reader, t):
+    while first_output(sim_gpio.outputs(), first_pin(reader), 1, t) is None:
+        time.sleep(0.005)
+
+# results gets (reader, swipe time, whether to measure the sequence it
+# started) for each swipe.
+
+def timing_swipes(reader, count, seq_len, results):
+    for _ in range(count):
+        t = swipe(reader)
+        results.append((reader, t, True))
+        wait_for_start(reader, t)
+        time.sleep(seq_len + random.uniform(0.02, 0.1))
+
+def restart_swipes(reader, count, seq_len, results):
+    for _ in range(count):
+        t = swipe(reader)
+        results.append((reader, t, False))
+        wait_for_start(reader, t)
+        time.sleep(random.uniform(0.0, seq_len * 0.8))
+        t = swipe(reader)
+        results.append((reader, t, True))
+        wait_for_start(reader, t)
+        time.sleep(seq_len + random.uniform(0.02, 0.1))
+
+def analyze(results):
+    """Returns: (actuation latencies, absolute step timing errors, count of
+    measured swipes whose sequence didn't run exactly as planned before the
+    reader's next swipe)"""
+    outputs = sim_gpio.outputs()
+    latencies = []
+    errors = []
+    bad = 0
+    measured = 0
+    for (reader, t, measure) in results:
+        if not measure:
+            continue
+        measured += 1
+        end = min([t2 for (r2, t2, m2) in results if r2 is reader and t2 > t],
+            default=float('inf'))
+        pins = reader_pins(reader)
+        offsets = output_offsets(reader)
+        start = first_output(outputs, first_pin(reader), 1, t)
+        if start is None:
+            bad += 1
+            continue
+        latencies.append(start - t)
+        seen = outputs_between(outputs, pins, start, end)
+        if len(seen) != len(offsets):
+            bad += 1
+        for ((ts, c, v), offset) in zip(seen, offsets):
+            errors.append(abs((ts - start) - offset))
+    return (latencies, errors, bad, measured)
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float('nan')
+    return sorted_vals[min(len(sorted_vals) - 1, int(len(sorted_vals) * p))]
+
+def report(name, vals):
+    vals.sort()
+    print('%-18s n=%-5d p50 %7.3f ms  p99 %7.3f ms  max %7.3f ms' % (name,
+        len(vals), percentile(vals, 0.50) * 1000, percentile(vals, 0.99) * 1000,
+        vals[-1] * 1000 if vals else float('nan')))
+    sys.stdout.flush()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark door controller sequence timing against '
+        'simulated GPIO')
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--swipes', type=int, default=20,
+        help='Swipes per reader, each after the previous sequence finished')
+    parser.add_argument('--restarts', type=int, default=20,
+        help='Swipes per reader that restart a running sequence')
+    parser.add_argument('--sleeps', default='0.05,0.1,0.05',
+        help='Comma-separated sleeps between the sequence\'s pin writes')
+    parser.add_argument('--load-threads', type=int, default=2,
+        help='Threads burning CPU in the controller process')
+    parser.add_argument('--validate-delay', type=float, default=0.0,
+        help='Seconds each tag check takes; checks always authorize')
+    parser.add_argument('--verbose', action='store_true',
+        help='Show the controller\'s log and each GPIO call')
+    args = parser.parse_args()
+
+    dc = load_door_controller(args.verbose)
+    sleeps = [float(s) for s in args.sleeps.split(',')]
+    seq_len = sum(sleeps)
+    controller = dc.DoorController(make_config(args.readers, sleeps))
+    # The auth path is replaced, so only the controller's own pipeline and
+    # sequence engine are measured.
+    def validate_tag(tag, trace):
+        if args.validate_delay:
+            time.sleep(args.validate_delay)
+        return True
+    for reader in controller.readers:
+        reader.validate_tag = validate_tag
+    controller.start()
+
+    stop = threading.Event()
+    for _ in range(args.load_threads):
+        threading.Thread(target=burn_cpu, args=(stop,), daemon=True).start()
+    try:
+        sim_gpio.clear_timeline()
+        results = []
+        run_swipes(controller.readers, timing_swipes,
+            (args.swipes, seq_len, results))
+        (latencies, errors, bad, measured) = analyze(results)
+        report('actuation', latencies)
+        report('step error', errors)
+        print('%d of %d sequences did not run as planned' % (bad, measured))
+
+        sim_gpio.clear_timeline()
+        results = []
+        run_swipes(controller.readers, restart_swipes,
+            (args.restarts, seq_len, results))
+        (latencies, errors, bad, measured) = analyze(results)
+        report('restart', latencies)
+        report('restart step error', errors)
+        print('%d of %d restarted sequences did not run as planned' % (bad,
+            measured))
+    finally:
+        stop.set()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import pty
+import random
+import selectors
+import sys
+import threading
+import time
+
+bin_dir = os.path.dirname(os.path.abspath(__file__))
+app_dir = os.path.dirname(bin_dir)
+sys.path.insert(0, os.path.join(app_dir, 'door-controller'))
+
+import rdm6300
+import parallax_rfid
+
+reader_classes = {
+    'rdm6300': rdm6300.RDM6300Reader,
+    'parallax': parallax_rfid.ParallaxRfidReader,
+}
+
+# A capture file holds one chunk of received bytes per line, as seconds since
+# the start of the capture and the bytes in hex. Lines starting with # are
+# comments.
+
+def write_capture(fn, reader_type, chunks, comment=None):
+    with open(fn, 'w') as f:
+        print('# reader_type=%s' % reader_type, file=f)
+        if comment:
+            print('# %s' % comment, file=f)
+        for (t, data) in chunks:
+            print('%.6f %s' % (t, data.hex()), file=f)
+
+def read_capture(fn):
+    """Returns: (reader type or None, list of (time, bytes))"""
+    reader_type = None
+    chunks = []
+    with open(fn, 'rt') as f:
+        for l in f:
+            l = l.strip()
+            if l.startswith('# reader_type='):
+                reader_type = l.split('=', 1)[1]
+            if not l or l.startswith('#'):
+                continue
+            (t, data) = l.split()
+            chunks.append((float(t), bytes.fromhex(data)))
+    return (reader_type, chunks)
+
+def record(reader_type, port, fn, duration):
+    import serial
+    cls = reader_classes[reader_type]
+    ser = serial.Serial(port, cls.baud, timeout=0.5)
+    chunks = []
+    start = time.monotonic()
+    print('Recording from %s; ^C to stop' % port)
+    try:
+        while duration is None or time.monotonic() < start + duration:
+            data = ser.read(ser.in_waiting or 1)
+            if data:
+                chunks.append((time.monotonic() - start, data))
+    except KeyboardInterrupt:
+        pass
+    write_capture(fn, reader_type, chunks)
+    print('Recorded %d bytes in %d chunks' % (sum(len(d) for (t, d) in chunks),
+        len(chunks)))
+
+def make_frame(cls, tag):
+    body = b'%02X%08X' % (random.randrange(256), tag)
+    if cls.crc_len:
+        crc = 0
+        for x in bytes.fromhex(body.decode()):
+            crc ^= x
+        body += b'%02X' % crc
+    return cls.start_char + body + cls.end_char
+
+def generate(reader_type, fn, swipes, repeats, noisy, truncated, overlong):
+    """Writes a synthetic capture of swipes tag presentations, each sending
+    the frame repeats times back to back, as an RDM6300 does while a tag is
+    held up. The given fractions of frames are corrupted.
+    """
+    cls = reader_classes[reader_type]
+    byte_time = 10.0 / cls.baud
+    counts = {'frames': 0, 'noisy': 0, 'truncated': 0, 'overlong': 0}
+    chunks = []
+    t = 0.0
+    for _ in range(swipes):
+        tag = random.randrange(1, 1 << 32)
+        for _ in range(repeats):
+            frame = make_frame(cls, tag)
+            r = random.random()
+            if r < noisy:
+                i = random.randrange(1, len(frame) - 1)
+                frame = frame[:i] + bytes([random.randrange(256)]) + frame[i+1:]
+                counts['noisy'] += 1
+            elif r < noisy + truncated:
+                frame = frame[:random.randrange(1, len(frame))]
+                counts['truncated'] += 1
+            elif r < noisy + truncated + overlong:
+                frame = frame[:-1] + b'0' * random.randint(1, 8) + frame[-1:]
+                counts['overlong'] += 1
+            counts['frames'] += 1
+            chunks.append((t, frame))
+            t += len(frame) * byte_time
+        t += random.uniform(0.5, 3.0)
+    write_capture(fn, reader_type, chunks, ' '.join('%s=%d' % kv
+        for kv in sorted(counts.items())))
+    print('Generated %d frames (%s)' % (counts['frames'], ', '.join(
+        '%s %d' % kv for kv in sorted(counts.items()) if kv[0] != 'frames')))
+
+# Counts reader events instead of acting on them.
+class EventCounter(object):
+    def __init__(self):
+        self.counts = dict.fromkeys(('tag', 'outside', 'timeout', 'overlong',
+            'invalid'), 0)
+
+    def handle_tag(self, tag, rcv_start_time, trace=None):
+        self.counts['tag'] += 1
+
+    def handle_data_outside_tag(self, data):
+        self.counts['outside'] += 1
+
+    def handle_timeout(self, data):
+        self.counts['timeout'] += 1
+
+    def handle_overlong_tag(self, data):
+        self.counts['overlong'] += 1
+
+    def handle_validation_error(self, data):
+        self.counts['invalid'] += 1
+
+def feed_pty(master, chunks, fast, done):
+    start = time.monotonic()
+    for (t, data) in chunks:
+        if not fast:
+            delay = start + t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        while data:
+            data = data[os.write(master, data):]
+    done.set()
+
+def replay(reader_type, chunks, fast, direct):
+    """Replays chunks into a reader through a pseudo-terminal, or straight
+    into its parser if direct is set.
+
+    Returns: (EventCounter, elapsed seconds, reader thread CPU seconds)
+    """
+    (master, slave) = pty.openpty()
+    counter = EventCounter()
+    rdr = reader_classes[reader_type](os.ttyname(slave), counter)
+    start = time.perf_counter()
+    start_cpu = time.thread_time()
+    if direct:
+        for (t, data) in chunks:
+            rdr.handle_data(data, t)
+    else:
+        done = threading.Event()
+        feeder = threading.Thread(target=feed_pty,
+            args=(master, chunks, fast, done))
+        feeder.start()
+        selector = selectors.DefaultSelector()
+        selector.register(rdr.fileno(), selectors.EVENT_READ)
+        # Stop once the feeder has finished and the port has gone quiet.
+        while selector.select(0.5) or not done.is_set():
+            if rdr.ser.in_waiting:
+                rdr.read_available()
+        feeder.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.thread_time() - start_cpu
+    rdr.ser.close()
+    os.close(master)
+    os.close(slave)
+    return (counter, elapsed, cpu)
+
+def report(counter, elapsed, cpu):
+    c = counter.counts
+    frames = c['tag'] + c['timeout'] + c['overlong'] + c['invalid']
+    print('%d frames in %.3f s: %.1f frames/s, %.1f us CPU/frame' % (frames,
+        elapsed, frames / elapsed if elapsed else float('nan'),
+        cpu / frames * 1e6 if frames else float('nan')))
+    print('tags %d  invalid %d  overlong %d  timeout %d  outside-data runs %d' % (
+        c['tag'], c['invalid'], c['overlong'], c['timeout'], c['outside']))
+    if frames:
+        print('decode error rate %.2f%%' % (
+            100.0 * (frames - c['tag']) / frames))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Record, generate and replay RFID reader serial data')
+    subparsers = parser.add_subparsers(dest='cmd')
+    subparsers.required = True
+
+    p = subparsers.add_parser('record',
+        help='Record the bytes received from a reader')
+    p.add_argument('--reader-type', choices=sorted(reader_classes),
+        required=True)
+    p.add_argument('--duration', type=float,
+        help='Seconds to record; default is until ^C')
+    p.add_argument('port', help='Serial port, as serial_port in door-controller.ini')
+    p.add_argument('capture', help='Capture file to write')
+
+    p = subparsers.add_parser('generate', help='Write a synthetic capture')
+    p.add_argument('--reader-type', choices=sorted(reader_classes),
+        required=True)
+    p.add_argument('--swipes', type=int, default=1000)
+    p.add_argument('--repeats', type=int, default=5,
+        help='Frames sent per swipe')
+    p.add_argument('--noisy', type=float, default=0.0,
+        help='Fraction of frames with a corrupted byte')
+    p.add_argument('--truncated', type=float, default=0.0,
+        help='Fraction of frames cut short')
+    p.add_argument('--overlong', type=float, default=0.0,
+        help='Fraction of frames with extra characters')
+    p.add_argument('--seed', type=int)
+    p.add_argument('capture', help='Capture file to write')
+
+    p = subparsers.add_parser('replay',
+        help='Replay a capture into a reader and report throughput')
+    p.add_argument('--reader-type', choices=sorted(reader_classes),
+        help='Default is the type recorded in the capture')
+    p.add_argument('--fast', action='store_true',
+        help='Replay as fast as possible instead of with the original timing')
+    p.add_argument('--direct', action='store_true',
+        help='Feed the parser directly, bypassing the pseudo-terminal')
+    p.add_argument('capture')
+
+    args = parser.parse_args()
+    if args.cmd == 'record':
+        record(args.reader_type, args.port, args.capture, args.duration)
+    elif args.cmd == 'generate':
+        if args.seed is not None:
+            random.seed(args.seed)
+        generate(args.reader_type, args.capture, args.swipes, args.repeats,
+            args.noisy, args.truncated, args.overlong)
+    else:
+        (reader_type, chunks) = read_capture(args.capture)
+        reader_type = args.reader_type or reader_type
+        if reader_type not in reader_classes:
+            raise Exception('Reader type not recorded; use --reader-type')
+        report(*replay(reader_type, chunks, args.fast, args.direct))
@@ -0,0 +1,116 @@
+import threading
+import time
+import traceback
+import urllib.parse
+
+# Parse a full ACL, as returned by /api/get-acl-0, into a set of RFIDs.
+def parse_acl(lines):
+    rfids = set()
+    for l in lines:
+        l = l.strip()
+        if not l or l.startswith('#'):
+            continue
+        rfids.add(int(l))
+    return rfids
+
+# Apply a delta, as returned by /api/get-acl-0?since=..., to a set of RFIDs.
+def apply_delta(rfids, lines):
+    rfids = set(rfids)
+    for l in lines:
+        l = l.strip()
+        if l.startswith('+'):
+            rfids.add(int(l[1:]))
+        elif l.startswith('-'):
+            rfids.discard(int(l[1:]))
+    return rfids
+
+# A local copy of one ACL, kept up to date from the auth server in the
+# background, so that tags can be validated from memory without a network
+# round trip, and while the auth server is unreachable. The mirror is only
+# trusted for max_age seconds after the last successful sync; after that,
+# lookup() returns None and the caller must check with the auth server.
+#
+# If long_poll is set, the mirror holds a long-poll request open on the auth
+# server, which answers as soon as the ACL changes, and only syncs then;
+# otherwise it polls every sync_interval seconds.
+class AclMirror(threading.Thread):
+    def __init__(self, client, acl, sync_interval, max_age, log,
+            long_poll=None):
+        super(AclMirror, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.acl = acl
+        self.sync_interval = sync_interval
+        self.max_age = max_age
+        self.log = log
+        self.long_poll = long_poll
+
+        # (rfids, version, sync time) is replaced as a whole, so lookups
+        # never see a partially applied update.
+        self.state = (None, None, None)
+
+    def run(self):
+        while True:
+            try:
+                self.sync()
+                while self.long_poll and self.state[1]:
+                    if self.wait_for_change():
+                        self.sync()
+            except:
+                self.log('EXCEPTION syncing ACL mirror (squashed):')
+                traceback.print_exc()
+            time.sleep(self.sync_interval)
+
+    # Returns True if the ACL changed, or False if the long-poll timed out,
+    # in which case the mirror is known to still be current.
+    def wait_for_change(self):
+        (rfids, version, synced) = self.state
+        path = '/api/wait-acl-change-0?acl=%s:%s&timeout=%s' % (
+            urllib.parse.quote(self.acl), urllib.parse.quote(version),
+            self.long_poll)
+        start = time.monotonic()
+        resp = self.client.get(path,
+            read_timeout=self.client.read_timeout + self.long_poll)
+        if resp.status != 200:
+            raise Exception('Auth server returned HTTP %d' % resp.status)
+        if resp.body.strip():
+            return True
+        now = time.monotonic()
+        self.state = (rfids, version, now)
+        # An empty answer long before the timeout means the auth server had
+        # too many long-polls waiting; poll for one interval instead.
+        if now < start + self.long_poll / 2:
+            time.sleep(self.sync_interval)
+        return False
+
+    def sync(self):
+        (rfids, version, synced) = self.state
+        path = '/api/get-acl-0/' + urllib.parse.quote(self.acl)
+        headers = {}
+        if version:
+            path += '?since=' + urllib.parse.quote(version)
+            headers['If-None-Match'] = '"%s"' % version
+        resp = self.client.get(path, headers)
+        now = time.monotonic()
+        if resp.status == 304:
+            self.state = (rfids, version, now)
+            return
+        if resp.status != 200:
+            raise Exception('Auth server returned HTTP %d' % resp.status)
+        lines = resp.body.decode('utf-8').splitlines()
+        new_version = (resp.headers.get('ETag') or '').strip('"') or None
+        if resp.headers.get('X-ACL-Delta-Since') == version and rfids is not None:
+            new_rfids = apply_delta(rfids, lines)
+            self.log('ACL mirror updated to version %s (%d changes)' % (
+                new_version, len(lines)))
+        else:
+            new_rfids = parse_acl(lines)
+            self.log('ACL mirror loaded version %s (%d RFIDs)' % (
+                new_version, len(new_rfids)))
+        self.state = (new_rfids, new_version, now)
+
+    def lookup(self, tag):
+        (rfids, version, synced) = self.state
+        if rfids is None or time.monotonic() > synced + self.max_age:
+            return None
+        return tag in rfids
@@ -0,0 +1,254 @@
+import collections
+import concurrent.futures
+import http.client
+import threading
+import time
+
+Response = collections.namedtuple('Response', ('status', 'headers', 'body'))
+
+# Consecutive failures after which a server is skipped
+breaker_failures = 3
+# Seconds a failing server is skipped for, before it's tried again
+breaker_open_interval = 30.0
+# Weight of each request's outcome in a server's health score
+score_weight = 0.2
+# Seconds for a server's health score to recover half way to 1, so a server
+# that has been passed over gets another chance
+score_recovery_half_life = 60.0
+# Servers scoring below this are tried after healthier ones
+healthy_score = 0.5
+# Response times remembered per server, for the hedging deadline
+latency_window = 100
+# Hedging deadline bounds, in seconds; the default is used until a server
+# has answered at least once
+hedge_min_delay = 0.02
+hedge_max_delay = 0.5
+hedge_default_delay = 0.25
+
+# HTTP client for the auth server. Connections are kept open between
+# requests, so a tag check normally costs a single request/response round
+# trip with no TCP handshake. Connecting and waiting for a response each have
+# their own timeout, so a hung or unreachable server can only delay a caller
+# by a bounded amount; any failure is raised to the caller, which should
+# treat it as "not authorized".
+#
+# One client is shared by everything in the process talking to the same auth
+# server. Each request takes an idle connection from the pool, or opens a new
+# one, so a long-poll held open by one thread doesn't block tag checks made
+# by another.
+class AuthClient(object):
+    def __init__(self, host, port, connect_timeout, read_timeout, max_idle=4):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.health = ServerHealth()
+
+    def _connect(self):
+        conn = http.client.HTTPConnection(self.host, self.port,
+            timeout=self.connect_timeout)
+        try:
+            conn.connect()
+        except:
+            conn.close()
+            raise
+        return conn
+
+    def _take_idle(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return None
+
+    def _put_idle(self, conn):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for conn in idle:
+            conn.close()
+
+    # read_timeout overrides the client's default, e.g. for long-polls.
+    def request(self, method, path, body=None, headers={}, read_timeout=None):
+        if read_timeout is None:
+            read_timeout = self.read_timeout
+        conn = self._take_idle()
+        while True:
+            reused = conn is not None
+            if not reused:
+                conn = self._connect()
+            try:
+                conn.sock.settimeout(read_timeout)
+                conn.request(method, path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except ConnectionError:
+                conn.close()
+                conn = None
+                # The server may have closed an idle kept-alive connection;
+                # retry once on a fresh connection. Timeouts aren't retried,
+                # since that would double the delay.
+                if reused:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._put_idle(conn)
+            return Response(resp.status, resp.headers, data)
+
+    def get(self, path, headers={}, read_timeout=None):
+        return self.request('GET', path, headers=headers,
+            read_timeout=read_timeout)
+
+# Health of one auth server, as seen by HedgedClient: recent response times,
+# a score between 0 and 1 that moves towards 1 on each timely answer and
+# towards 0 on each failure or answer beaten by another server, and a circuit
+# breaker that opens after breaker_failures consecutive failures.
+class ServerHealth(object):
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=latency_window)
+        self._score = 1.0
+        self.score_time = time.monotonic()
+        self.failures = 0
+        self.open_until = 0.0
+        self.lock = threading.Lock()
+
+    def score(self):
+        elapsed = time.monotonic() - self.score_time
+        return 1.0 - (1.0 - self._score) * 0.5 ** (
+            elapsed / score_recovery_half_life)
+
+    def _adjust_score(self, target):
+        self._score = self.score() + (target - self.score()) * score_weight
+        self.score_time = time.monotonic()
+
+    # Once breaker_open_interval has passed, requests are let through again;
+    # the next failure re-opens the breaker.
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    # beaten is set if another server had already answered.
+    def record_success(self, seconds, beaten=False):
+        with self.lock:
+            self.latencies.append(seconds)
+            self._adjust_score(0.0 if beaten else 1.0)
+            self.failures = 0
+            self.open_until = 0.0
+
+    # Returns True if this failure opened the breaker.
+    def record_failure(self):
+        with self.lock:
+            self._adjust_score(0.0)
+            self.failures += 1
+            if self.failures < breaker_failures:
+                return False
+            self.open_until = time.monotonic() + breaker_open_interval
+            return True
+
+    def percentile(self, p):
+        with self.lock:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+# Sends each request to an ordered list of auth servers, skipping any whose
+# circuit breaker is open, and trying unhealthy ones last. If a server
+# hasn't answered within the hedge_percentile of its recent response times,
+# or fails, the request is also sent to the next server. The first valid
+# response wins; slower requests finish in the background, and still update
+# their server's health. If every server fails, the last error is raised.
+#
+# Each attempt runs on its own thread rather than a shared pool, so an
+# attempt never queues behind attempts that other readers (or earlier
+# requests) left waiting on a hung server, and no request takes longer than
+# its servers' timeouts allow. With only one server to try, the request is
+# made in the caller's thread.
+class HedgedClient(object):
+    def __init__(self, clients, hedge_percentile, log):
+        self.clients = clients
+        self.hedge_percentile = hedge_percentile
+        self.log = log
+
+    def candidates(self):
+        available = [c for c in self.clients if c.health.available()]
+        # If every breaker is open, trying is still better than failing.
+        if not available:
+            available = list(self.clients)
+        return sorted(available,
+            key=lambda c: c.health.score() < healthy_score)
+
+    def hedge_delay(self, client):
+        delay = client.health.percentile(self.hedge_percentile)
+        if delay is None:
+            return hedge_default_delay
+        return min(max(delay, hedge_min_delay), hedge_max_delay)
+
+    def _attempt(self, client, answered, method, path, body, headers):
+        start = time.monotonic()
+        try:
+            resp = client.request(method, path, body=body, headers=headers)
+            if resp.status != 200:
+                raise Exception('Auth server %s:%d returned HTTP %d' % (
+                    client.host, client.port, resp.status))
+        except:
+            if client.health.record_failure():
+                self.log('Auth server %s:%d failing; skipping it for %d seconds' % (
+                    client.host, client.port, breaker_open_interval))
+            raise
+        client.health.record_success(time.monotonic() - start,
+            answered.is_set())
+        answered.set()
+        return resp
+
+    def _start_attempt(self, *args):
+        future = concurrent.futures.Future()
+        def threadfunc():
+            try:
+                future.set_result(self._attempt(*args))
+            except Exception as e:
+                future.set_exception(e)
+        threading.Thread(target=threadfunc, daemon=True).start()
+        return future
+
+    def request(self, method, path, body=None, headers={}):
+        waiting = self.candidates()
+        answered = threading.Event()
+        if len(waiting) == 1:
+            return self._attempt(waiting[0], answered, method, path, body,
+                headers)
+        pending = []
+        error = None
+        while waiting or pending:
+            timeout = None
+            if waiting:
+                client = waiting.pop(0)
+                pending.append(self._start_attempt(client, answered, method,
+                    path, body, headers))
+                if waiting:
+                    timeout = self.hedge_delay(client)
+            (done, not_done) = concurrent.futures.wait(pending, timeout,
+                concurrent.futures.FIRST_COMPLETED)
+            for f in done:
+                pending.remove(f)
+                try:
+                    return f.result()
+                except Exception as e:
+                    error = e
+        raise error
+
+    def get(self, path, headers={}):
+        return self.request('GET', path, headers=headers)
@@ -5,20 +5,32 @@ try:
     import configparser
 except:
     import ConfigParser as configparser
+import heapq
 import itertools
 import os
+import queue
 import socket
 import sys
-import queue
+import selectors
+import signal
 import threading
 import time
 import traceback
 import urllib.parse
-import urllib.request
+
+import acl_mirror
+import auth_client
+import latency
+import log_shipper
+import status
 
 door_controller_dir = os.path.dirname(__file__)
 app_dir = os.path.dirname(door_controller_dir)
 etc_dir = os.path.join(app_dir, 'etc')
+spool_dir = os.path.join(app_dir, 'var', 'spool')
+
+# Tags waiting to be validated, per reader, before further tags are dropped
+tag_queue_len = 8
 
 def print_with_timestamp(s):
     print(time.strftime('%Y%m%d %H%M%S'), s)
@@ -30,26 +42,11 @@ try:
 except:
     print_with_timestamp('WARNING: import RPi.GPIO failed')
     print_with_timestamp('WARNING: EMULATING all GPIO accesses')
-    class GPIO:
-        BOARD = 0
-        OUT = 0
-        HIGH = 0
-        LOW = 0
-
-        @classmethod
-        def setmode(klass, mode):
-            print_with_timestamp("GPIO-debug: GPIO.setmode(%s)" % repr(mode))
-
-        @classmethod
-        def setup(klass, gpio, direction):
-            print_with_timestamp("GPIO-debug: GPIO.setup(%s, %s)" % (repr(gpio), repr(direction)))
-
-        @classmethod
-        def output(klass, gpio, value):
-            print_with_timestamp("GPIO-debug: GPIO.output(%s, %s)" % (repr(gpio), repr(value)))
+    import sim_gpio as GPIO
+    GPIO.log = print_with_timestamp
 
 class SleepStep(object):
-    args_conversions = (int,)
+    args_conversions = (float,)
 
     def __init__(self, delay):
         self.delay = delay
@@ -91,6 +88,26 @@ class GpioOutStep(object):
     def __repr__(self):
         return self.__str__()
 
+# Several gpio.out steps that run at the same time, written by a single
+# multi-channel GPIO.output call. Only created by compile_sequence().
+class FusedGpioOutStep(object):
+    def __init__(self, steps):
+        self.gpios = [step.gpio for step in steps]
+        self.vals = [step.val for step in steps]
+
+    def __call__(self):
+        if len(self.gpios) == 1:
+            GPIO.output(self.gpios[0], self.vals[0])
+        else:
+            GPIO.output(self.gpios, self.vals)
+
+    def __str__(self):
+        return ';'.join('gpio.out,%d,%d' % gv
+            for gv in zip(self.gpios, self.vals))
+
+    def __repr__(self):
+        return self.__str__()
+
 class LogStep(object):
     args_conversions = (str,)
 
@@ -136,172 +153,627 @@ def parse_sequence(conf_section, seqname):
         sequence.append(action_constructor(*action_args_converted))
     return sequence
 
+# Compile a parsed sequence into a plan: a list of (seconds from the start of
+# the sequence, step), without sleeps, so the scheduler runs each step at an
+# absolute deadline. Runs of gpio.out steps with nothing between them are
+# fused into one FusedGpioOutStep. Every gpio.out pin must have been set up
+# by a gpio.setup.out step, either in setup_pins or earlier in the sequence.
+def compile_sequence(sequence, setup_pins, seqname):
+    setup_pins = set(setup_pins)
+    plan = []
+    offset = 0
+    for step in sequence:
+        if isinstance(step, SleepStep):
+            offset += step.delay
+            continue
+        if isinstance(step, GpioSetupOutStep):
+            setup_pins.add(step.gpio)
+        elif isinstance(step, GpioOutStep):
+            if step.gpio not in setup_pins:
+                raise Exception('%s: %s before gpio.setup.out,%d' % (
+                    seqname, step, step.gpio))
+            if plan:
+                (prev_offset, prev_step) = plan[-1]
+                if (prev_offset == offset and
+                        isinstance(prev_step, FusedGpioOutStep) and
+                        step.gpio not in prev_step.gpios):
+                    prev_step.gpios.append(step.gpio)
+                    prev_step.vals.append(step.val)
+                    continue
+            step = FusedGpioOutStep([step])
+        plan.append((offset, step))
+    return plan
+
+# Runs the steps of every sequence, for all readers, in one long-lived
+# thread. Sequences waiting to run their next step are kept in a heap ordered
+# by due time.
+class Scheduler(object):
+    def __init__(self):
+        self.heap = []
+        self.entry_ids = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.threadfunc, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def schedule(self, due, seq_timer):
+        with self.cond:
+            heapq.heappush(self.heap, (due, next(self.entry_ids), seq_timer))
+            self.cond.notify()
+
+    def threadfunc(self):
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        (due, entry_id, seq_timer) = heapq.heappop(self.heap)
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap else None)
+            seq_timer.run_steps()
+
+# Runs one compiled sequence (see compile_sequence()) on the Scheduler. Each
+# step's deadline is fixed relative to the sequence's start, so delays don't
+# accumulate.
 class SequenceTimer(object):
-    def __init__(self, sequence, notifier):
-        self.sequence = sequence
+    def __init__(self, plan, notifier, scheduler, trace=None):
+        self.plan = plan
         self.notifier = notifier
+        self.scheduler = scheduler
+        self.trace = trace
 
-        self.queue = queue.Queue()
-        self.thread = threading.Thread(target=self.threadfunc)
+        self.step = 0
+        self.start_time = None
+        self.cancelled = False
+        self.done = threading.Event()
 
     def start(self):
-        self.thread.start()
+        self.start_time = time.monotonic()
+        self.scheduler.schedule(self.start_time, self)
 
     def join(self):
-        self.thread.join()
+        self.done.wait()
 
+    # Never blocks. No further steps run after this returns; the only step
+    # that can still be running is one the scheduler had already started.
+    # The scheduler discards the sequence when it next comes due.
     def cancel(self):
-        self.queue.put(None)
-        self.thread.join()
+        self.cancelled = True
 
-    def threadfunc(self):
+    # Called by the scheduler when the next step is due. Runs every step
+    # that's due, then reschedules for the one after.
+    def run_steps(self):
         try:
-            delay=0
-            for action in self.sequence:
-                try:
-                    self.queue.get(timeout=delay)
-                except queue.Empty as e:
-                    if isinstance(action, SleepStep):
-                        delay = action.delay
-                    else:
-                        delay = 0
-                        action()
-                else:
-                    break
-        finally:
-            if self.notifier:
-                self.notifier.sequence_complete(self)
+            if self.step == 0 and self.trace:
+                self.trace.mark('seq_start')
+            while not self.cancelled and self.step < len(self.plan):
+                (offset, action) = self.plan[self.step]
+                due = self.start_time + offset
+                if due > time.monotonic():
+                    self.scheduler.schedule(due, self)
+                    return
+                self.step += 1
+                action()
+                if self.trace and isinstance(action, FusedGpioOutStep):
+                    now = time.monotonic()
+                    self.trace.mark('gpio_out', now)
+                    self.trace.add_gpio_lateness(now - due)
+        except:
+            print_with_timestamp('EXCEPTION in sequence (abandoning it):')
+            traceback.print_exc()
+        if self.notifier:
+            self.notifier.sequence_complete(self)
+        self.done.set()
+
+# Settled level that fires an input trigger, for each edge; None for either
+input_edges = {
+    'rising': 1,
+    'falling': 0,
+    'both': None,
+}
+
+input_pulls = {
+    'up': 'PUD_UP',
+    'down': 'PUD_DOWN',
+    'off': 'PUD_OFF',
+}
+
+# An input pin, configured as
+#   input.<name>=<pin>,<edge>,<pull>,<debounce ms>,<action>
+# whose edges cancel the reader's running sequence and then start the
+# sequence named by action, or just cancel it if action is "cancel". The
+# GPIO library calls edge() from its own thread when the pin changes; the
+# pin is read again once it has been quiet for the debounce time, as a
+# one-step sequence on the Scheduler, and the trigger fires only if the
+# settled level differs from the last one. Nothing polls the pin.
+class InputTrigger(object):
+    def __init__(self, reader, conf_section, key):
+        self.reader = reader
+        self.name = key[len('input.'):]
+        try:
+            (gpio, edge, pull, debounce, action) = conf_section[key].split(',')
+            self.gpio = int(gpio)
+            self.fire_level = input_edges[edge]
+            self.pull = input_pulls[pull]
+            self.debounce = float(debounce) / 1000.0
+        except:
+            raise Exception('Invalid %s' % key)
+        if action == 'cancel':
+            self.plan = None
+        else:
+            sequence = parse_sequence(conf_section, action)
+            if not sequence:
+                raise Exception('%s: no sequence %s' % (key, action))
+            self.plan = compile_sequence(sequence, reader.setup_pins,
+                reader.name + ' ' + action)
+        self.action = action
+
+        self.level = None
+        self.check_timer = None
 
+    def start(self):
+        GPIO.setup(self.gpio, GPIO.IN,
+            pull_up_down=getattr(GPIO, self.pull))
+        self.level = GPIO.input(self.gpio)
+        # Both edges are watched, so the settled level is always current.
+        GPIO.add_event_detect(self.gpio, GPIO.BOTH, callback=self.edge)
+
+    # Each edge pushes the check back, so it runs once the pin has been
+    # quiet for the debounce time.
+    def edge(self, channel):
+        if self.check_timer:
+            self.check_timer.cancel()
+        self.check_timer = SequenceTimer([(self.debounce, self.check)], None,
+            self.reader.scheduler)
+        self.check_timer.start()
+
+    def check(self):
+        level = GPIO.input(self.gpio)
+        if level == self.level:
+            return
+        self.level = level
+        if self.fire_level is None or level == self.fire_level:
+            self.reader.handle_input(self)
+
+# Handles one RFID reader and the GPIO sequences it triggers. The thread runs
+# the init sequence and opens the serial port. After that, the shared
+# DoorController loop reads the port and calls handle_tag(), which only
+# queues the tag; this thread validates queued tags and starts sequences, so
+# reading the serial ports never waits for the network.
 class RfidReaderThread(threading.Thread):
-    def __init__(self, conf_section):
-        super(RfidReaderThread, self).__init__()
+    def __init__(self, controller, conf_section):
+        super(RfidReaderThread, self).__init__(name=conf_section.name)
+        self.daemon = True
 
         self.reader_type = conf_section['reader_type']
         self.serial_port = conf_section['serial_port']
-        self.auth_host = conf_section['auth_host']
-        self.auth_port = int(conf_section['auth_port'])
+        auth_clients = [controller.get_auth_client(host, port,
+                conf_section.getfloat('auth_connect_timeout', 2.0),
+                conf_section.getfloat('auth_read_timeout', 3.0))
+            for (host, port) in parse_auth_hosts(conf_section)]
+        # Tag checks are hedged across all auth servers; the ACL mirror and
+        # access log shipping use the first.
+        self.auth_servers = controller.get_hedged_client(auth_clients,
+            conf_section.getfloat('auth_hedge_percentile', 95.0) / 100.0)
+        self.auth_client = auth_clients[0]
         self.acl = conf_section['acl']
+        if conf_section.getboolean('acl_mirror', False):
+            self.acl_mirror = controller.get_acl_mirror(self.auth_client,
+                self.acl,
+                conf_section.getfloat('acl_mirror_sync_interval', 60.0),
+                conf_section.getfloat('acl_mirror_max_age', 86400.0),
+                conf_section.getfloat('acl_mirror_long_poll', 0.0))
+            self.log_shipper = controller.get_log_shipper(self.auth_client)
+        else:
+            self.acl_mirror = None
+            self.log_shipper = None
         self.restart_action = conf_section.getboolean('restart_action')
-        self.init_seq = parse_sequence(conf_section, 'init')
-        self.authorized_seq = parse_sequence(conf_section, 'authorized')
-        self.unauthorized_seq = parse_sequence(conf_section, 'unauthorized')
-
+        init_seq = parse_sequence(conf_section, 'init')
+        self.setup_pins = set(step.gpio for step in init_seq
+            if isinstance(step, GpioSetupOutStep))
+        self.init_plan = compile_sequence(init_seq, (),
+            self.name + ' init')
+        self.authorized_plan = compile_sequence(
+            parse_sequence(conf_section, 'authorized'), self.setup_pins,
+            self.name + ' authorized')
+        self.unauthorized_plan = compile_sequence(
+            parse_sequence(conf_section, 'unauthorized'), self.setup_pins,
+            self.name + ' unauthorized')
+        self.input_triggers = [InputTrigger(self, conf_section, key)
+            for key in conf_section if key.startswith('input.')]
+        self.input_pins = set()
+        for trigger in self.input_triggers:
+            if trigger.gpio in self.setup_pins | self.input_pins:
+                raise Exception('%s: GPIO %d used twice' % (self.name,
+                    trigger.gpio))
+            self.input_pins.add(trigger.gpio)
+
+        self.scheduler = controller.scheduler
+        self.status = controller.status
+        self.rdr = None
+        self.started = threading.Event()
+        self.tag_queue = queue.Queue(tag_queue_len)
+        # Tags queued or being processed
+        self.pending_tags = set()
+        self.pending_lock = threading.Lock()
         self.seq_timer = None
         self.sw_state_lock = threading.Lock()
 
+    def log(self, s):
+        print_with_timestamp('%s: %s' % (self.name, s))
+
+    def count(self, counter, n=1):
+        self.status.count(self.name, counter, n)
+
+    def event(self, kind, detail):
+        self.status.event(self.name, kind, detail)
+
     def run(self):
         try:
-            GPIO.setmode(GPIO.BOARD)
-            print_with_timestamp('Running init sequence')
-            st = SequenceTimer(self.init_seq, None)
+            self.log('Running init sequence')
+            st = SequenceTimer(self.init_plan, None, self.scheduler)
             st.start()
             st.join()
-            print_with_timestamp('Completed init sequence')
+            self.log('Completed init sequence')
+            for trigger in self.input_triggers:
+                trigger.start()
+                self.log('Watching input %s on GPIO %d' % (trigger.name,
+                    trigger.gpio))
             if self.reader_type == 'rdm6300':
                 import rdm6300
                 rlte = rdm6300.RateLimitTagEvents(self)
-                rdr = rdm6300.RDM6300Reader(self.serial_port, rlte)
+                self.rdr = rdm6300.RDM6300Reader(self.serial_port, rlte)
             elif self.reader_type == 'parallax':
                 import parallax_rfid
                 rlte = parallax_rfid.RateLimitTagEvents(self)
-                rdr = parallax_rfid.ParallaxRfidReader(self.serial_port, rlte)
+                self.rdr = parallax_rfid.ParallaxRfidReader(self.serial_port, rlte)
             else:
                 raise Exception('Invalid reader type: ' + self.reader_type)
-            rdr.run()
         except:
-            print_with_timestamp('EXCEPTION in main loop (exiting):')
+            self.log('EXCEPTION starting reader:')
             traceback.print_exc()
-            sys.exit(1)
-
-    def handle_tag(self, tag, rcv_start_time):
-        print_with_timestamp('Tag: ' + repr(tag))
-
-        authorized = self.validate_tag(tag)
+        self.started.set()
+        if self.rdr:
+            self.process_tags()
+
+    # Called from the serial reading loop, so must never block. A tag that is
+    # already queued or being validated is merged with the pending event.
+    def handle_tag(self, tag, rcv_start_time, trace=None):
+        with self.pending_lock:
+            if tag in self.pending_tags:
+                self.count('tags_merged')
+                return
+            try:
+                self.tag_queue.put_nowait((tag, rcv_start_time, trace))
+            except queue.Full:
+                self.log('Tag queue full; dropping tag ' + repr(tag))
+                self.count('tags_dropped')
+                self.event('dropped', 'Tag queue full; dropped tag %d' % tag)
+                return
+            self.pending_tags.add(tag)
+        self.count('tags_queued')
+
+    def process_tags(self):
+        while True:
+            (tag, rcv_start_time, trace) = self.tag_queue.get()
+            try:
+                self.process_tag(tag, rcv_start_time, trace)
+            except Exception as e:
+                self.log('EXCEPTION processing tag (squashed):')
+                traceback.print_exc()
+                self.count('errors')
+                self.event('error', 'Processing tag %d: %r' % (tag, e))
+            with self.pending_lock:
+                self.pending_tags.discard(tag)
+
+    def process_tag(self, tag, rcv_start_time, trace=None):
+        self.log('Tag: ' + repr(tag))
+        if trace is None:
+            trace = latency.Trace(rcv_start_time)
+        trace.mark('dequeued')
+
+        authorized = self.validate_tag(tag, trace)
         if authorized:
-            print_with_timestamp('Tag authorized')
+            self.log('Tag authorized')
+            self.count('authorized')
         else:
-            print_with_timestamp('Tag NOT authorized')
+            self.log('Tag NOT authorized')
+            self.count('denied')
+        self.event('tag', '%d %s' % (tag,
+            'authorized' if authorized else 'NOT authorized'))
 
-        previously_running_timer = None
         with self.sw_state_lock:
-            # We can't use self.seq_timer without sw_state_lock held,
-            # since the timer callback could run and clear
-            # self.seq_timer.
+            # The scheduler clears self.seq_timer when the sequence completes.
+            # Cancelling doesn't wait for the scheduler, so the lock is only
+            # held briefly.
             previously_running_timer = self.seq_timer
-
-        if previously_running_timer:
-            if not (authorized and self.restart_action):
-                print_with_timestamp('Ignore; previous sequence is running')
-                return
-
-        if previously_running_timer:
-            print_with_timestamp('Cancelling existing sequence')
-            previously_running_timer.cancel()
-            # The following join() must happen without sw_state_lock held,
-            # since the timer callback can hold that lock, and if we hold it,
-            # join() might deadlock waiting for the timer callback to complete,
-            # yet it can't complete since we hold the lock.
-            previously_running_timer.join()
-            self.seq_timer = None
-
+            ignore = previously_running_timer and not (authorized and
+                self.restart_action)
+            if not ignore:
+                if previously_running_timer:
+                    previously_running_timer.cancel()
+                if authorized:
+                    plan = self.authorized_plan
+                else:
+                    plan = self.unauthorized_plan
+                self.seq_timer = SequenceTimer(plan, self, self.scheduler, trace)
+                self.seq_timer.start()
+
+        if ignore:
+            self.log('Ignore; previous sequence is running')
+            self.count('sequences_ignored')
+            self.finish_trace(trace)
+        elif previously_running_timer:
+            self.log('Cancelled existing sequence')
+            self.count('sequences_restarted')
+
+    # Called by an InputTrigger, on the scheduler thread, once an edge has
+    # settled. Input triggers always take over from a running sequence.
+    def handle_input(self, trigger):
+        self.log('Input %s is %d; %s' % (trigger.name, trigger.level,
+            trigger.action))
+        self.count('inputs')
+        self.event('input', '%s %d %s' % (trigger.name, trigger.level,
+            trigger.action))
         with self.sw_state_lock:
-            if authorized:
-                seq = self.authorized_seq
-            else:
-                seq = self.unauthorized_seq
-            self.seq_timer = SequenceTimer(seq, self)
-            self.seq_timer.start()
+            if self.seq_timer:
+                self.seq_timer.cancel()
+                self.seq_timer = None
+            if trigger.plan is not None:
+                self.seq_timer = SequenceTimer(trigger.plan, self,
+                    self.scheduler)
+                self.seq_timer.start()
 
     def sequence_complete(self, seq_timer):
         with self.sw_state_lock:
             if self.seq_timer == seq_timer:
                 self.seq_timer = None
+        if seq_timer.trace:
+            self.finish_trace(seq_timer.trace)
 
+    def finish_trace(self, trace):
+        self.log('Latency: ' + str(trace))
+        latency.stats.record(self.name, trace)
+
+    # Reader errors are only counted, and recorded as status events; they
+    # aren't logged, since a noisy reader would flood the log.
     def handle_data_outside_tag(self, data):
-        pass
+        self.count('outside_runs')
+        self.count('outside_bytes', len(data))
 
     def handle_timeout(self, data):
-        pass
+        self.count('timeouts')
+        self.event('timeout', repr(data))
 
     def handle_overlong_tag(self, data):
-        pass
+        self.count('overlong')
+        self.event('overlong', repr(data))
 
     def handle_validation_error(self, data):
-        pass
-
-    def validate_tag(self, tag):
+        self.count('invalid')
+        self.event('invalid', repr(data))
+
+    # Use the local ACL mirror if it's fresh enough, and report the decision
+    # to the auth server afterwards. Otherwise, ask the auth server.
+    def validate_tag(self, tag, trace):
+        trace.mark('validate_sent')
+        if self.acl_mirror:
+            authorized = self.acl_mirror.lookup(tag)
+            if authorized is not None:
+                trace.mark('mirror_answered')
+                self.count('validated_by_mirror')
+                self.log_shipper.report(self.acl, tag, authorized)
+                return authorized
+            self.log('ACL mirror not loaded or stale; asking auth server')
+            self.count('mirror_stale')
+        authorized = self.validate_tag_remote(tag)
+        trace.mark('auth_answered')
+        return authorized
+
+    # Fails closed: any error, including a timeout, means "not authorized".
+    def validate_tag_remote(self, tag):
         try:
-            url = 'http://%s:%d/api/check-access-0/%s/%s' % (
-                self.auth_host,
-                self.auth_port,
+            path = '/api/check-access-0/%s/%s' % (
                 urllib.parse.quote(self.acl),
                 urllib.parse.quote(str(tag)))
-            with urllib.request.urlopen(url) as f:
-                answer = f.read()
-                return answer.decode('utf-8') == 'True'
-        except:
-            print_with_timestamp('EXCEPTION in access check (squashed):')
+            resp = self.auth_servers.get(path)
+            self.count('validated_by_auth')
+            return resp.body.decode('utf-8') == 'True'
+        except Exception as e:
+            self.log('EXCEPTION in access check (squashed; denying access):')
             traceback.print_exc()
-            pass
+            self.count('auth_errors')
+            self.event('auth_error', repr(e))
         return False
 
-config = configparser.ConfigParser(inline_comment_prefixes=('#'))
-config.read(etc_dir + '/door-controller.ini')
-# FIXME: To enable multiple device controllers on one host, take a cmdline arg
-# naming the device this process should handle, and add that device name into
-# each entry in sec_names. Or, search for all section names with our hostname,
-# and start a thread for each.
-sec_names = [
-    'conf.' + socket.gethostname(),
-    'conf'
-]
-sec = None
-for sec_name in sec_names:
-    if sec_name in config:
-        sec = config[sec_name]
-        break
-if sec is None:
-    raise Exception('No valid section found in configuration file')
-rfid_reader_thread = RfidReaderThread(sec)
-rfid_reader_thread.start()
-rfid_reader_thread.join()
+# Returns the auth servers a section names, in order of preference: a list of
+# host:port in auth_hosts, or else the single auth_host and auth_port.
+def parse_auth_hosts(conf_section):
+    if 'auth_hosts' not in conf_section:
+        return [(conf_section['auth_host'], int(conf_section['auth_port']))]
+    hosts = []
+    for host_port in conf_section['auth_hosts'].replace(',', ' ').split():
+        (host, _, port) = host_port.rpartition(':')
+        if not host:
+            raise Exception('Invalid auth_hosts entry: ' + host_port)
+        hosts.append((host, int(port)))
+    return hosts
+
+# Runs every reader configured for this host in one process. All serial
+# ports are read by a single selector loop, everything talking to the same
+# auth server shares one HTTP connection pool, readers using the same ACL
+# share one mirror, and GPIO is set up once, with each pin owned by exactly
+# one reader.
+class DoorController(object):
+    def __init__(self, conf_sections, settings=None):
+        self.start_time = time.monotonic()
+        if settings is not None:
+            self.status_host = settings.get('status_host', '127.0.0.1')
+            self.status_port = settings.getint('status_port', 0)
+        else:
+            self.status_port = 0
+        self.status = status.Status()
+        self.scheduler = Scheduler()
+        self.auth_clients = {}
+        self.hedged_clients = {}
+        self.acl_mirrors = {}
+        self.log_shippers = {}
+        self.readers = [RfidReaderThread(self, sec) for sec in conf_sections]
+        self.check_gpio_owners()
+        self.log_latency_now = threading.Event()
+
+    def get_auth_client(self, host, port, connect_timeout, read_timeout):
+        key = (host, port)
+        if key not in self.auth_clients:
+            self.auth_clients[key] = auth_client.AuthClient(host, port,
+                connect_timeout, read_timeout)
+        return self.auth_clients[key]
+
+    def get_hedged_client(self, clients, hedge_percentile):
+        key = (tuple((c.host, c.port) for c in clients), hedge_percentile)
+        if key not in self.hedged_clients:
+            self.hedged_clients[key] = auth_client.HedgedClient(clients,
+                hedge_percentile, print_with_timestamp)
+        return self.hedged_clients[key]
+
+    def get_acl_mirror(self, client, acl, sync_interval, max_age, long_poll):
+        key = (client.host, client.port, acl)
+        if key not in self.acl_mirrors:
+            self.acl_mirrors[key] = acl_mirror.AclMirror(client, acl,
+                sync_interval, max_age, print_with_timestamp, long_poll)
+        return self.acl_mirrors[key]
+
+    def get_log_shipper(self, client):
+        key = (client.host, client.port)
+        if key not in self.log_shippers:
+            spool_fn = os.path.join(spool_dir,
+                'door-controller-%s-%d.spool' % key)
+            self.log_shippers[key] = log_shipper.LogShipper(client, spool_fn,
+                print_with_timestamp)
+        return self.log_shippers[key]
+
+    def check_gpio_owners(self):
+        owners = {}
+        for reader in self.readers:
+            for gpio in reader.setup_pins | reader.input_pins:
+                owner = owners.setdefault(gpio, reader)
+                if owner is not reader:
+                    raise Exception('GPIO %d used by both %s and %s' % (
+                        gpio, owner.name, reader.name))
+
+    # Logs latency histograms every latency.log_interval seconds, and on
+    # SIGUSR1.
+    def log_latency(self):
+        while True:
+            self.log_latency_now.wait(latency.log_interval)
+            self.log_latency_now.clear()
+            latency.stats.log_summary(print_with_timestamp)
+
+    def status_snapshot(self):
+        (counters, events) = self.status.snapshot()
+        now = time.monotonic()
+        snapshot = {
+            'uptime': now - self.start_time,
+            'readers': {},
+            'auth_servers': {},
+            'acl_mirrors': {},
+            'log_shippers': {},
+            'latency': dict(('%s %s' % key, summary)
+                for (key, summary) in latency.stats.summary().items()),
+            'events': events,
+        }
+        for reader in self.readers:
+            snapshot['readers'][reader.name] = {
+                'counters': counters.get(reader.name, {}),
+                'queued': reader.tag_queue.qsize(),
+                'sequence_running': reader.seq_timer is not None,
+                'inputs': dict((trigger.name, trigger.level)
+                    for trigger in reader.input_triggers),
+            }
+        for ((host, port), client) in self.auth_clients.items():
+            snapshot['auth_servers']['%s:%d' % (host, port)] = {
+                'score': client.health.score(),
+                'available': client.health.available(),
+                'consecutive_failures': client.health.failures,
+                'p95_seconds': client.health.percentile(0.95),
+            }
+        for ((host, port, acl), mirror) in self.acl_mirrors.items():
+            (rfids, version, synced) = mirror.state
+            snapshot['acl_mirrors']['%s:%d/%s' % (host, port, acl)] = {
+                'version': version,
+                'rfids': len(rfids) if rfids is not None else None,
+                'age_seconds': now - synced if synced is not None else None,
+            }
+        for ((host, port), shipper) in self.log_shippers.items():
+            snapshot['log_shippers']['%s:%d' % (host, port)] = {
+                'queued': shipper.queue.qsize(),
+                'spooled': shipper.spooled(),
+            }
+        return snapshot
+
+    # Starts everything except reading the serial ports, and returns once
+    # every reader has run its init sequence.
+    def start(self):
+        if self.status_port:
+            status.start_server(self.status_host, self.status_port,
+                self.status_snapshot)
+            print_with_timestamp('Status at http://%s:%d/status' % (
+                self.status_host, self.status_port))
+        threading.Thread(target=self.log_latency, daemon=True).start()
+        for mirror in self.acl_mirrors.values():
+            mirror.start()
+        for shipper in self.log_shippers.values():
+            shipper.start()
+        GPIO.setmode(GPIO.BOARD)
+        self.scheduler.start()
+        # Init sequences run in parallel; the readers start once all are done.
+        for reader in self.readers:
+            reader.start()
+        for reader in self.readers:
+            reader.started.wait()
+
+    def run(self):
+        signal.signal(signal.SIGUSR1,
+            lambda signum, frame: self.log_latency_now.set())
+        self.start()
+        selector = selectors.DefaultSelector()
+        for reader in self.readers:
+            if reader.rdr is None:
+                raise Exception('Reader %s failed to start' % reader.name)
+            selector.register(reader.rdr.fileno(), selectors.EVENT_READ,
+                reader.rdr)
+        print_with_timestamp('Reading tags from %d readers' % len(self.readers))
+        while True:
+            for (key, events) in selector.select():
+                key.data.read_available()
+
+# Every section named conf.<hostname> or conf.<hostname>.<device> configures
+# one reader; the plain conf section is used if there are none.
+def find_conf_sections(config, hostname):
+    prefix = 'conf.' + hostname
+    secs = [config[n] for n in config.sections()
+        if n == prefix or n.startswith(prefix + '.')]
+    if not secs and 'conf' in config:
+        secs = [config['conf']]
+    return secs
+
+def main():
+    config = configparser.ConfigParser(inline_comment_prefixes=('#'))
+    config.read(etc_dir + '/door-controller.ini')
+    secs = find_conf_sections(config, socket.gethostname())
+    if not secs:
+        raise Exception('No valid section found in configuration file')
+    settings = None
+    if 'door-controller' in config:
+        settings = config['door-controller']
+    controller = DoorController(secs, settings)
+    try:
+        controller.run()
+    except:
+        print_with_timestamp('EXCEPTION in main loop (exiting):')
+        traceback.print_exc()
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+import bisect
+import threading
+import time
+
+# Seconds between latency summaries in the log
+log_interval = 3600.0
+
+# Histogram bucket upper bounds, in seconds
+buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Stages a tag event passes through, in order. Each is timed from the
+# previous stage that was reached. The ACL mirror or the auth server answers
+# a validation request, so network time shows up separately from local
+# lookups.
+stages = (
+    'rcv_start',        # First byte of the frame received
+    'frame',            # Frame complete
+    'rate_limit',       # Passed the repeated-tag rate limit
+    'dequeued',         # Taken from the reader's tag queue
+    'validate_sent',    # Validation started
+    'mirror_answered',  # Validated from the local ACL mirror
+    'auth_answered',    # Validated by the auth server
+    'seq_start',        # Sequence started
+    'gpio_out',         # First GPIO output step executed
+)
+
+# Monotonic timestamps for each stage of handling one tag event.
+class Trace(object):
+    def __init__(self, rcv_start_time):
+        self.marks = [('rcv_start', rcv_start_time)]
+        # How late each GPIO output step ran, relative to the sequence's
+        # schedule
+        self.gpio_lateness = []
+
+    def mark(self, stage, t=None):
+        if t is None:
+            t = time.monotonic()
+        self.marks.append((stage, t))
+
+    def add_gpio_lateness(self, seconds):
+        self.gpio_lateness.append(seconds)
+
+    # Returns: list of (stage, seconds since the previous stage), using the
+    # first time each stage was reached, plus ('total', seconds from the
+    # first byte to the first GPIO output) if one ran.
+    def stage_times(self):
+        first = {}
+        for (stage, t) in self.marks:
+            first.setdefault(stage, t)
+        result = []
+        prev = None
+        for stage in stages:
+            if stage not in first:
+                continue
+            if prev is not None:
+                result.append((stage, first[stage] - prev))
+            prev = first[stage]
+        if 'gpio_out' in first:
+            result.append(('total', first['gpio_out'] - first['rcv_start']))
+        return result
+
+    def __str__(self):
+        s = ', '.join('%s %.1fms' % (stage, secs * 1000)
+            for (stage, secs) in self.stage_times())
+        if self.gpio_lateness:
+            s += ', gpio late max %.1fms' % (max(self.gpio_lateness) * 1000)
+        return s
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def count(self):
+        return sum(self.counts)
+
+    # Returns the upper bound of the bucket holding the p'th percentile.
+    def percentile(self, p):
+        target = self.count() * p
+        cumulative = 0
+        for (i, n) in enumerate(self.counts):
+            cumulative += n
+            if n and cumulative >= target:
+                return buckets[i] if i < len(buckets) else self.max
+        return 0.0
+
+    def __str__(self):
+        n = self.count()
+        return 'n=%d mean=%.1fms p50<=%.1fms p99<=%.1fms max=%.1fms' % (n,
+            self.sum / n * 1000 if n else 0.0, self.percentile(0.5) * 1000,
+            self.percentile(0.99) * 1000, self.max * 1000)
+
+# Per-reader, per-stage latency histograms, accumulated over the life of the
+# process.
+class LatencyStats(object):
+    def __init__(self):
+        self.hists = {}
+        self.lock = threading.Lock()
+
+    def _observe(self, key, value):
+        h = self.hists.get(key)
+        if h is None:
+            h = self.hists[key] = Histogram()
+        h.observe(value)
+
+    def record(self, reader_name, trace):
+        with self.lock:
+            for (stage, secs) in trace.stage_times():
+                self._observe((reader_name, stage), secs)
+            for secs in trace.gpio_lateness:
+                self._observe((reader_name, 'gpio_late'), secs)
+
+    # Returns: dict mapping (reader name, stage) to histogram summary string
+    def summary(self):
+        with self.lock:
+            return dict((key, str(h)) for (key, h) in self.hists.items())
+
+    def log_summary(self, log):
+        summary = self.summary()
+        if not summary:
+            log('Latency: no tag events yet')
+        order = stages + ('total', 'gpio_late')
+        for key in sorted(summary, key=lambda k: (k[0], order.index(k[1]))):
+            log('Latency: %s %s: %s' % (key[0], key[1], summary[key]))
+
+stats = LatencyStats()
@@ -0,0 +1,126 @@
+import itertools
+import os
+import queue
+import threading
+import time
+import traceback
+import uuid
+
+# Ships access decisions made by this controller to the auth server's access
+# log. Callers only queue a record, so logging never delays unlocking. A
+# background thread sends queued records in batches to
+# /api/log-remote-access-check-batch-0. While the auth server can't be
+# reached, records are appended to a spool file on local disk, and sent
+# (oldest first) once it's back. Each record carries a unique ID, which the
+# auth server uses to discard duplicates, so a batch can safely be resent if
+# its response was lost.
+class LogShipper(threading.Thread):
+    def __init__(self, client, spool_fn, log, batch_size=100,
+            flush_interval=1.0, retry_interval=30.0):
+        super(LogShipper, self).__init__()
+        self.daemon = True
+        self.client = client
+        self.spool_fn = spool_fn
+        self.log = log
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retry_interval = retry_interval
+        self.queue = queue.Queue()
+
+        self.id_prefix = uuid.uuid4().hex[:12] + '.'
+        self.id_seq = itertools.count()
+        self.ts_lock = threading.Lock()
+        self.last_ts = None
+        self.ts_seq_num = 0
+
+    # Same format as the auth server's access log timestamps.
+    def gen_ts(self):
+        with self.ts_lock:
+            ts = time.strftime('%Y%m%dT%H%M%S.')
+            if ts == self.last_ts:
+                self.ts_seq_num += 1
+            else:
+                self.ts_seq_num = 0
+            self.last_ts = ts
+            return ts + str(self.ts_seq_num)
+
+    def report(self, acl, tag, result):
+        record = '%s%d,%s,%s,%s,%s' % (self.id_prefix, next(self.id_seq),
+            self.gen_ts(), acl, tag, repr(result))
+        self.queue.put(record)
+
+    def run(self):
+        while True:
+            try:
+                timeout = self.retry_interval if self.spooled() else None
+                batch = [self.queue.get(timeout=timeout)]
+            except queue.Empty:
+                batch = []
+            # Give closely spaced records a chance to share a request.
+            time.sleep(self.flush_interval)
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.ship(batch)
+            except:
+                self.log('EXCEPTION shipping access log records (squashed):')
+                traceback.print_exc()
+
+    def ship(self, batch):
+        # Records must reach the server in order, so once anything is
+        # spooled, new records join the end of the spool.
+        if self.spooled():
+            self.append_spool(batch)
+            self.ship_spool()
+            return
+        for i in range(0, len(batch), self.batch_size):
+            if not self.send(batch[i:i + self.batch_size]):
+                self.append_spool(batch[i:])
+                return
+
+    def send(self, records):
+        try:
+            resp = self.client.request('POST',
+                '/api/log-remote-access-check-batch-0',
+                body=''.join(r + '\n' for r in records).encode('utf-8'),
+                headers={'Content-Type': 'text/plain'})
+            if resp.status != 200:
+                raise Exception('Auth server returned HTTP %d' % resp.status)
+            return True
+        except Exception as e:
+            self.log('Could not ship %d access log records: %s' % (
+                len(records), repr(e)))
+            return False
+
+    def spooled(self):
+        return os.path.exists(self.spool_fn)
+
+    def append_spool(self, records):
+        if not records:
+            return
+        with open(self.spool_fn, 'at') as f:
+            f.write(''.join(r + '\n' for r in records))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def ship_spool(self):
+        with open(self.spool_fn, 'rt') as f:
+            records = f.read().splitlines()
+        sent = 0
+        while sent < len(records):
+            if not self.send(records[sent:sent + self.batch_size]):
+                break
+            sent += self.batch_size
+        if sent >= len(records):
+            os.unlink(self.spool_fn)
+            self.log('Shipped %d spooled access log records' % len(records))
+        elif sent:
+            tmp_fn = self.spool_fn + '.tmp'
+            with open(tmp_fn, 'wt') as f:
+                f.write(''.join(r + '\n' for r in records[sent:]))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_fn, self.spool_fn)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import binascii
 import rfid_base
 import sys
 
@@ -20,8 +21,8 @@ class RDM6300Reader(rfid_base.RFIDReader):
 
     def _crc_valid(self, buf):
         crc_calc = 0
-        for x in [buf[i:i+2] for i in range(0, len(buf), 2)]:
-            crc_calc ^= int(x, 16)
+        for x in binascii.unhexlify(buf):
+            crc_calc ^= x
         return crc_calc == 0
 
 if __name__ == '__main__':
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
+import binascii
+import latency
 import serial
 import sys
 import time
 
 start_end_timeout = 0.2
+inter_byte_timeout = 0.05
 repeat_delay = 2.0
 
 # Print a tag value for debugging
@@ -12,8 +15,8 @@ class TagPrinter(object):
     def __init__(self):
         pass
 
-    def handle_tag(self, tag, rcv_start_time):
-        print('TAG:', tag, rcv_start_time)
+    def handle_tag(self, tag, rcv_start_time, trace=None):
+        print('TAG:', tag, rcv_start_time, trace)
 
     def handle_data_outside_tag(self, data):
         print('OUTSIDE TAG:', repr(data))
@@ -37,13 +40,15 @@ class RateLimitTagEvents(object):
         self.last_tag = None
         self.last_rcv_start_time = 0
 
-    def handle_tag(self, tag, rcv_start_time):
+    def handle_tag(self, tag, rcv_start_time, trace=None):
         if (tag == self.last_tag and
                 rcv_start_time < self.last_rcv_start_time + repeat_delay):
             return
         self.last_tag = tag
         self.last_rcv_start_time = rcv_start_time
-        self.handler.handle_tag(tag, rcv_start_time)
+        if trace:
+            trace.mark('rate_limit')
+        self.handler.handle_tag(tag, rcv_start_time, trace)
 
     def handle_data_outside_tag(self, data):
         self.handler.handle_data_outside_tag(data)
@@ -60,59 +65,121 @@ class RateLimitTagEvents(object):
 # Read tag transmissions from an RFID reader via serial port, validate any
 # applicable CRC, convert tag ID to integer, and invoke a handler for each tag
 # transmission.
+#
+# Bytes are read in chunks, and all bytes in a chunk share one receive time,
+# from time.monotonic().
+# The frame being received is collected in a preallocated buffer; the parser
+# searches each chunk for the start and end characters rather than looking at
+# one byte at a time. Data outside a frame is reported once per run of bytes,
+# rather than once per byte.
 class RFIDReader(object):
     def __init__(self, port, handler):
         self.handler = handler
         self.rfid_len = self.leader_len + self.tag_len + self.crc_len
-        self.ser = serial.Serial(port, self.baud)
+        self.start_byte = self.start_char[0]
+        self.end_byte = self.end_char[0]
+        self.buf = bytearray(self.rfid_len)
+        self.ser = serial.Serial(port, self.baud,
+            inter_byte_timeout=inter_byte_timeout)
+        self._reset_buf()
 
     def run(self):
-        self._reset_buf()
         while True:
-            c = self.ser.read(1)
-            t = time.time()
-            # Start character?
-            # Start receiving new tag data
-            if c == self.start_char:
-                self.buf = b''
-                self.rcv_start_time = t
-            # buf is None?
-            # Start character not yet seen; ignore
-            elif self.buf is None:
-                self.handler.handle_data_outside_tag(c)
+            # Returns once a whole frame has arrived, or the line goes quiet.
+            data = self.ser.read(max(self.ser.in_waiting, self.rfid_len + 2))
+            self.handle_data(data, time.monotonic())
+
+    def fileno(self):
+        return self.ser.fileno()
+
+    # Process whatever has already arrived on the serial port. For use when
+    # a selector reports the port readable, so this doesn't block.
+    def read_available(self):
+        data = self.ser.read(self.ser.in_waiting or 1)
+        self.handle_data(data, time.monotonic())
+
+    def handle_data(self, data, t):
+        view = memoryview(data)
+        i = 0
+        n = len(data)
+        while i < n:
+            # Start character not yet seen; skip to it
+            if self.buf_len is None:
+                j = data.find(self.start_char, i)
+                if j < 0:
+                    j = n
+                if j > i:
+                    self.handler.handle_data_outside_tag(data[i:j])
+                if j < n:
+                    self._start_frame(t)
+                i = j + 1
+                continue
             # Too long since start character?
-            # Tag transmission took too long; reset state
-            elif t >= (self.rcv_start_time + start_end_timeout):
-                self.handler.handle_timeout(self.buf)
+            # Tag transmission took too long; reset state. The character that
+            # showed this is dropped, unless it starts a new frame.
+            if (data[i] != self.start_byte and
+                    t >= (self.rcv_start_time + start_end_timeout)):
+                self.handler.handle_timeout(self._frame())
                 self._reset_buf()
+                i += 1
+                continue
+            # Record characters up to the next start/end character, or until
+            # the buffer is full
+            limit = min(n, i + self.rfid_len - self.buf_len)
+            j = data.find(self.start_char, i, limit)
+            k = data.find(self.end_char, i, limit)
+            if j < 0 or (0 <= k < j):
+                j = k
+            if j < 0:
+                j = limit
+            self.buf[self.buf_len:self.buf_len + j - i] = view[i:j]
+            self.buf_len += j - i
+            i = j
+            if i == n:
+                break
+            c = data[i]
+            i += 1
+            # Start character?
+            # Start receiving new tag data
+            if c == self.start_byte:
+                self._start_frame(t)
             # End character?
             # Process received tag data
-            elif c == self.end_char:
-                tag = self._convert_validate(self.buf)
+            elif c == self.end_byte:
+                tag = self._convert_validate(self.buf, self.buf_len)
                 if tag:
-                    self.handler.handle_tag(tag, self.rcv_start_time)
+                    trace = latency.Trace(self.rcv_start_time)
+                    trace.mark('frame', t)
+                    self.handler.handle_tag(tag, self.rcv_start_time, trace)
                 else:
-                    self.handler.handle_validation_error(self.buf)
+                    self.handler.handle_validation_error(self._frame())
                 self._reset_buf()
             # Buffer too long for tag data?
             # Corruption, so reset buffer
-            elif len(self.buf) >= self.rfid_len:
-                self.handler.handle_overlong_tag(self.buf)
-                self._reset_buf()
-            # Record received character for later use
             else:
-                self.buf += c
+                self.handler.handle_overlong_tag(self._frame())
+                self._reset_buf()
+
+    def _start_frame(self, t):
+        self.buf_len = 0
+        self.rcv_start_time = t
 
     def _reset_buf(self):
-        self.buf = None
+        self.buf_len = None
         self.rcv_start_time = None
 
-    def _convert_validate(self, buf):
-        if len(buf) != self.rfid_len:
+    def _frame(self):
+        return bytes(self.buf[:self.buf_len])
+
+    # The tag is ASCII hex; unhexlify() rejects any non-hex character.
+    def _convert_validate(self, buf, buf_len):
+        if buf_len != self.rfid_len:
             return None
         try:
             if self.crc_len and not self._crc_valid(buf):
                 return None
-            return int(buf[self.leader_len:(self.leader_len+self.tag_len)], 16)
-        except:
+            tag = binascii.unhexlify(
+                buf[self.leader_len:(self.leader_len+self.tag_len)])
+        except binascii.Error:
             return None
+        return int.from_bytes(tag, 'big')
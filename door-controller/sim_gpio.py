@@ -0,0 +1,96 @@
+import threading
+import time
+
+# Stands in for RPi.GPIO where it isn't available. Every call is logged, if
+# verbose is set, and recorded in timeline with a time.monotonic() timestamp
+# if recording is set, so tests and benchmarks can check sequence timing
+# without a Raspberry Pi. Recording is off by default, since the timeline
+# grows without limit.
+
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+HIGH = 1
+LOW = 0
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+verbose = True
+recording = False
+log = print
+
+# List of (time, function name, args)
+timeline = []
+timeline_lock = threading.Lock()
+
+# Input levels, and (edge, callback) for inputs with edge detection, by
+# channel
+levels = {}
+event_callbacks = {}
+
+def record(name, *args):
+    if recording:
+        t = time.monotonic()
+        with timeline_lock:
+            timeline.append((t, name, args))
+    if verbose:
+        log('GPIO-debug: GPIO.%s(%s)' % (name, ', '.join(repr(a) for a in args)))
+
+def clear_timeline():
+    with timeline_lock:
+        del timeline[:]
+
+# Returns: list of (time, channel, value), one per channel written, in order
+def outputs():
+    with timeline_lock:
+        calls = [(t, args) for (t, name, args) in timeline if name == 'output']
+    result = []
+    for (t, (channels, values)) in calls:
+        if isinstance(channels, (list, tuple)):
+            if not isinstance(values, (list, tuple)):
+                values = [values] * len(channels)
+            result.extend((t, c, v) for (c, v) in zip(channels, values))
+        else:
+            result.append((t, channels, values))
+    return result
+
+def setmode(mode):
+    record('setmode', mode)
+
+def setup(channel, direction, pull_up_down=PUD_OFF):
+    record('setup', channel, direction, pull_up_down)
+    if direction == IN and channel not in levels:
+        levels[channel] = HIGH if pull_up_down == PUD_UP else LOW
+
+def output(channel, value):
+    record('output', channel, value)
+
+def input(channel):
+    record('input', channel)
+    return levels.get(channel, LOW)
+
+def add_event_detect(channel, edge, callback=None, bouncetime=None):
+    record('add_event_detect', channel, edge)
+    event_callbacks[channel] = (edge, callback)
+
+def remove_event_detect(channel):
+    record('remove_event_detect', channel)
+    event_callbacks.pop(channel, None)
+
+# Simulates something outside driving an input pin. Edge callbacks are
+# called in the caller's thread, where RPi.GPIO would use its own.
+def set_input(channel, value):
+    record('set_input', channel, value)
+    prev = levels.get(channel, LOW)
+    levels[channel] = value
+    if channel not in event_callbacks or value == prev:
+        return
+    (edge, callback) = event_callbacks[channel]
+    if edge == BOTH or edge == (RISING if value else FALLING):
+        if callback:
+            callback(channel)
@@ -0,0 +1,61 @@
+import collections
+import http.server
+import json
+import threading
+import time
+
+# Recent events kept for the status endpoint
+events_len = 200
+
+# Counters and a ring buffer of recent events, per reader, for the status
+# endpoint. Updating either costs one short lock hold, so readers can record
+# every frame error without slowing down.
+class Status(object):
+    def __init__(self):
+        self.counters = {}
+        self.events = collections.deque(maxlen=events_len)
+        self.lock = threading.Lock()
+
+    def count(self, reader, counter, n=1):
+        with self.lock:
+            counters = self.counters.setdefault(reader, {})
+            counters[counter] = counters.get(counter, 0) + n
+
+    def event(self, reader, kind, detail):
+        with self.lock:
+            self.events.append((time.strftime('%Y%m%d %H%M%S'), reader, kind,
+                detail))
+
+    # Returns: (dict mapping reader name to its counters, list of events
+    # newest first)
+    def snapshot(self):
+        with self.lock:
+            counters = dict((reader, dict(c))
+                for (reader, c) in self.counters.items())
+            events = [dict(zip(('time', 'reader', 'kind', 'detail'), e))
+                for e in reversed(self.events)]
+        return (counters, events)
+
+# Serves the result of snapshot_func() as JSON at /status. Runs in a daemon
+# thread, so it never holds up tag handling.
+def start_server(host, port, snapshot_func):
+    class StatusHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/status'):
+                self.send_error(404)
+                return
+            body = json.dumps(snapshot_func(), indent=1,
+                sort_keys=True).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), StatusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server